@@ -0,0 +1,275 @@
+"""
+This file keeps request latency bounded under overload (admission control)
+
+Without it a slow query or an exhausted connection pool makes requests wait
+until Apache gives up, while more keep queueing behind them. Instead
+- Every request gets a deadline (CATALOG_DEADLINE seconds, or DEADLINES for
+  its route). Waiting for a pooled connection is capped by what's left of
+  it (and CATALOG_POOL_TIMEOUT), and on Postgres so is every statement:
+  each transaction begins with SET LOCAL statement_timeout to the time
+  left, which ends with the transaction (commit or rollback)
+- A request that would wait behind more than CATALOG_MAX_POOL_WAITERS others
+  for a connection, or beyond CATALOG_MAX_IN_FLIGHT requests in this
+  process, is answered 503 with Retry-After right away (shed) instead of
+  adding to the queue
+- A request that runs out of time waiting for a connection or in a
+  statement is answered 503 too, instead of a 500
+
+/metrics.json shows this process's counters: requests in flight and
+blocked waiting for a connection, admitted and shed requests (by reason),
+timeouts and the latency of the admitted requests. Each process counts its
+own. Only requests made on the server itself (not through a proxy) or
+carrying 'X-Catalog-Metrics: <CATALOG_METRICS_TOKEN>' see it, others get a
+404
+
+Settings (environment variables)
+    CATALOG_DEADLINE           seconds a request may take (10)
+    CATALOG_DEADLINES          per route, e.g. 'bulk_movies_json=30,
+                               solo_json=2' (see DEADLINES)
+    CATALOG_POOL_TIMEOUT       longest wait for a pooled connection (2)
+    CATALOG_MAX_POOL_WAITERS   requests allowed to wait for a connection
+                               before more are shed (10)
+    CATALOG_MAX_IN_FLIGHT      requests per process before more are shed,
+                               0 for no limit (0)
+    CATALOG_METRICS_TOKEN      lets requests from elsewhere read
+                               /metrics.json (none)
+"""
+import collections
+import contextvars
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import g, make_response, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+DEADLINE = float(os.environ.get('CATALOG_DEADLINE', '10'))
+POOL_TIMEOUT = float(os.environ.get('CATALOG_POOL_TIMEOUT', '2'))
+MAX_POOL_WAITERS = int(os.environ.get('CATALOG_MAX_POOL_WAITERS', '10'))
+MAX_IN_FLIGHT = int(os.environ.get('CATALOG_MAX_IN_FLIGHT', '0'))
+METRICS_TOKEN = os.environ.get('CATALOG_METRICS_TOKEN')
+METRICS_HEADER = 'X-Catalog-Metrics'
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+# Routes that need longer than DEADLINE: the logins wait on Google/Facebook,
+# bulk writes touch many rows
+DEADLINES = {
+    'gconnect': 20,
+    'fbconnect': 20,
+    'bulk_movies_json': 30,
+}
+for item in os.environ.get('CATALOG_DEADLINES', '').split(','):
+    if item.strip():
+        endpoint, seconds = item.split('=')
+        DEADLINES[endpoint.strip()] = float(seconds)
+
+# Never shed: they don't use the database, or report on the load itself
+EXEMPT = ('static_asset', 'avatar', 'metrics', 'ready')
+# Postgres' error code for a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+log = logging.getLogger(__name__)
+
+# Absolute time.monotonic() the current request must be done by, None
+# outside requests (background jobs, scripts)
+deadline = contextvars.ContextVar('deadline', default=None)
+
+lock = threading.Lock()
+counters = collections.Counter()
+gauges = {'in_flight': 0, 'pool_waiters': 0}
+# Durations of the last admitted requests, for the percentiles
+latencies = collections.deque(maxlen=1000)
+
+
+def count(name, amount=1):
+    with lock:
+        counters[name] += amount
+
+
+def adjust(gauge, amount):
+    with lock:
+        gauges[gauge] += amount
+        return gauges[gauge]
+
+
+def time_left():
+    '''
+        Returns
+            seconds (float): What's left of the current request's deadline,
+                None outside a request
+    '''
+    until = deadline.get()
+    if until is None:
+        return None
+    return until - time.monotonic()
+
+
+class DeadlinePool(QueuePool):
+    '''
+        A QueuePool whose checkout timeout is the smaller of its timeout and
+        the current request's time left, and which counts the checkouts
+        blocked waiting for a connection.
+    '''
+    @property
+    def _timeout(self):
+        left = time_left()
+        if left is None:
+            return self._pool_timeout
+        # 0 would mean 'don't wait at all' only by accident, keep it > 0
+        return max(0.001, min(self._pool_timeout, left))
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._pool_timeout = value
+
+    def _do_get(self):
+        # Only a checkout finding every connection taken, and no overflow
+        # left to open another, waits for one to be returned
+        waits = (self._max_overflow > -1 and
+                 self._overflow >= self._max_overflow and
+                 self._pool.empty())
+        if not waits:
+            return super()._do_get()
+        adjust('pool_waiters', 1)
+        try:
+            return super()._do_get()
+        finally:
+            adjust('pool_waiters', -1)
+
+
+def queue_options():
+    return {'poolclass': DeadlinePool, 'pool_timeout': POOL_TIMEOUT}
+
+
+def pool_options(url):
+    '''
+        Returns
+            options (dict): create_engine() keyword arguments for url (a
+                SQLite file is pooled by sqlite_mode.py instead)
+    '''
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+    return queue_options()
+
+
+def set_statement_timeout(connection):
+    left = time_left()
+    if left is None:
+        # Outside requests the server's setting applies
+        return
+    # LOCAL: nothing outlives the transaction, so a request's timeout can't
+    # leak into the next use of the connection
+    connection.exec_driver_sql('SET LOCAL statement_timeout = %d'
+                               % max(1, int(left * 1000)))
+
+
+def service_unavailable(message, reason):
+    count(reason)
+    response = make_response(json.dumps(message), 503)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def admit():
+    if request.endpoint in EXEMPT:
+        return None
+    if gauges['pool_waiters'] >= MAX_POOL_WAITERS:
+        log.warning("Shedding %s: %d requests waiting for a connection",
+                    request.endpoint, gauges['pool_waiters'])
+        return service_unavailable('Server busy, retry shortly',
+                                   'shed_pool_waiters')
+    if MAX_IN_FLIGHT and gauges['in_flight'] >= MAX_IN_FLIGHT:
+        log.warning("Shedding %s: %d requests in flight", request.endpoint,
+                    gauges['in_flight'])
+        return service_unavailable('Server busy, retry shortly',
+                                   'shed_in_flight')
+
+    adjust('in_flight', 1)
+    count('admitted')
+    g.admitted_at = time.monotonic()
+    deadline.set(g.admitted_at + DEADLINES.get(request.endpoint, DEADLINE))
+    return None
+
+
+def release(exception=None):
+    admitted_at = g.pop('admitted_at', None)
+    if admitted_at is None:
+        return
+    deadline.set(None)
+    adjust('in_flight', -1)
+    with lock:
+        latencies.append(time.monotonic() - admitted_at)
+
+
+def pool_timeout(error):
+    return service_unavailable('Database busy, retry shortly',
+                               'pool_timeouts')
+
+
+def statement_timeout(error):
+    if getattr(error.orig, 'pgcode', None) != QUERY_CANCELED:
+        # Any other database error stays a 500
+        raise error
+    return service_unavailable('Request took too long, retry shortly',
+                               'statement_timeouts')
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(len(samples) * fraction))
+    return round(samples[index] * 1000, 1)
+
+
+def metrics_allowed():
+    '''
+        Returns
+            allowed (bool): Whether the request may read the metrics: it
+                was made on this machine and not passed on by a proxy, or
+                it carries the metrics token
+    '''
+    if METRICS_TOKEN and hmac.compare_digest(
+            request.headers.get(METRICS_HEADER, ''), METRICS_TOKEN):
+        return True
+    return (request.remote_addr in LOCAL_ADDRESSES and
+            'X-Forwarded-For' not in request.headers)
+
+
+def metrics():
+    if not metrics_allowed():
+        response = make_response(json.dumps('Not found'), 404)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    with lock:
+        data = dict(gauges, **counters)
+        samples = list(latencies)
+    data['pid'] = os.getpid()
+    data['latency_ms'] = {'p50': percentile(samples, 0.5),
+                          'p99': percentile(samples, 0.99),
+                          'samples': len(samples)}
+    response = make_response(json.dumps(data, sort_keys=True))
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def init_app(app, engines):
+    '''
+        Registers the admission hooks and the statement timeouts of the
+        Postgres engines. Call it before the app's own hooks.
+    '''
+    app.before_request(admit)
+    app.teardown_request(release)
+    app.register_error_handler(exc.TimeoutError, pool_timeout)
+    app.register_error_handler(exc.OperationalError, statement_timeout)
+    app.add_url_rule('/metrics.json', 'metrics', metrics)
+    for engine in engines:
+        if engine.dialect.name == 'postgresql':
+            event.listen(engine, 'begin', set_statement_timeout)
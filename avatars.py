@@ -0,0 +1,193 @@
+"""
+This file keeps local thumbnails of the users' profile pictures
+
+User.picture (and login_session['picture']) is a Google/Facebook URL, so
+every page showing an avatar made the browser download a full size image
+from a third party. Instead each picture is fetched once, in the background
+(tasks.py), resized to the sizes the pages show (SIZES) and stored under
+CATALOG_AVATAR_DIR, named after a hash of its content
+    <dir>/<sha256 of the picture>-<size>.jpg
+    <dir>/sources/<sha256 of the remote URL>   -> which picture it is
+The files never change, so /avatars/<name> serves them with immutable
+caching
+
+Templates call avatar_url(picture, size): the local thumbnail's URL when it
+has been fetched, the remote URL otherwise. The picture is fetched again on
+every login (refresh_later(), called by gconnect/fbconnect), so a changed
+picture shows up after the next login
+
+Fetch the pictures of every user once, e.g. after deploying this
+    python avatars.py
+
+Requirements
+    pip install Pillow
+Without it avatars aren't cached and pages keep showing the remote URLs
+"""
+import hashlib
+import io
+import logging
+import os
+import sys
+import time
+import warnings
+
+import requests
+from flask import send_from_directory, url_for
+
+import tasks
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, remote pictures are used without
+    Image = None
+
+DIRECTORY = os.environ.get('CATALOG_AVATAR_DIR',
+                           '/var/www/catalog/avatars')
+# Sizes (px) the templates display avatars at
+SIZES = (40, 300)
+# Don't download or decode anything bigger than this
+MAX_BYTES = 5 * 1024 * 1024
+MAX_PIXELS = 20 * 1000 * 1000
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# How long a worker trusts what it read from sources/ (another process may
+# have fetched a newer picture for the same URL)
+SOURCE_SECONDS = 60
+
+log = logging.getLogger(__name__)
+# Remote URL -> (content hash, time read)
+sources = {}
+
+
+def source_path(picture):
+    digest = hashlib.sha256(picture.encode('utf-8')).hexdigest()
+    return os.path.join(DIRECTORY, 'sources', digest)
+
+
+def write_file(path, data):
+    # Through a temporary name, so readers never see half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def thumbnail(data, size):
+    '''
+        Returns
+            jpeg (bytes): data cropped to a square and resized to size px
+    '''
+    # Bigger images raise instead of being decoded (a warning by default)
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    else:
+        image = image.convert('RGB')
+
+    side = min(image.size)
+    left = (image.width - side) // 2
+    top = (image.height - side) // 2
+    image = image.crop((left, top, left + side, top + side))
+    image = image.resize((size, size), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=85, optimize=True)
+    return output.getvalue()
+
+
+def fetch(picture):
+    '''
+        Downloads a picture and stores its thumbnails. Raises if that
+        failed, so the background job is retried.
+
+        Params
+            picture (str): Remote URL of the picture
+
+        Returns
+            digest (str): Content hash the thumbnails are stored under
+    '''
+    response = requests.get(picture, timeout=10, stream=True)
+    response.raise_for_status()
+    data = response.raw.read(MAX_BYTES + 1, decode_content=True)
+    if len(data) > MAX_BYTES:
+        raise ValueError("Picture %s is too big" % picture)
+
+    digest = hashlib.sha256(data).hexdigest()
+    for size in SIZES:
+        path = os.path.join(DIRECTORY, '%s-%d.jpg' % (digest, size))
+        if not os.path.exists(path):
+            write_file(path, thumbnail(data, size))
+    write_file(source_path(picture), digest.encode('ascii'))
+    sources[picture] = (digest, time.time())
+    return digest
+
+
+def cached_digest(picture):
+    digest, read_at = sources.get(picture, (None, 0))
+    if time.time() - read_at > SOURCE_SECONDS:
+        try:
+            with open(source_path(picture)) as f:
+                digest = f.read().strip()
+        except IOError:
+            # Don't remember misses, the picture may be fetched any moment
+            return None
+        sources[picture] = (digest, time.time())
+    return digest
+
+
+def avatar_url(picture, size):
+    '''
+        Returns
+            url (str): Local thumbnail of picture at size px if it was
+                fetched, the remote picture otherwise
+    '''
+    if not picture or Image is None or size not in SIZES:
+        return picture
+    digest = cached_digest(picture)
+    if digest is None:
+        return picture
+    return url_for('avatar', name='%s-%d.jpg' % (digest, size))
+
+
+def send_avatar(name):
+    response = send_from_directory(DIRECTORY, name, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def refresh_later(session, picture):
+    '''
+        Queues a (re-)fetch of a picture, e.g. when its user logs in.
+    '''
+    if picture and Image is not None:
+        tasks.enqueue(session, 'fetch_avatar', picture=picture)
+
+
+def init_app(app):
+    app.jinja_env.globals['avatar_url'] = avatar_url
+    app.add_url_rule('/avatars/<name>', 'avatar', send_avatar)
+
+
+if __name__ == '__main__':
+    # Import the app as the 'catalog' package, like catalog.wsgi does
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from catalog import session
+    from database_setup import User
+
+    if Image is None:
+        sys.exit("Pillow isn't installed (pip install Pillow)")
+    pictures = set(picture for picture, in session.query(User.picture)
+                   if picture)
+    for picture in sorted(pictures):
+        try:
+            print("%s %s" % (fetch(picture), picture))
+        except Exception as e:
+            print("FAILED %s: %s" % (picture, e))
@@ -0,0 +1,457 @@
+"""
+This file backs up and restores the catalog's users, genres and movies
+(archived ones too, see movie_archive.py)
+
+A pg_dump only restores into Postgres and lotsofitems.py only has the demo
+movies. This writes the user, genre and movie tables into a portable
+directory that restores into Postgres or SQLite alike, streaming: memory
+use doesn't grow with the number of rows
+
+Layout
+    <dir>/manifest.json           tables, columns and chunks, written last
+    <dir>/<table>-<n>.tsv.gz      one chunk: up to CHUNK_ROWS rows
+- A chunk holds the rows of one id range, in Postgres' COPY text format
+  (tab separated, \\N for NULL, backslash escapes), gzip compressed
+- manifest.json lists every chunk with its id range, row count and the
+  SHA-256 of the file; a backup without it is incomplete
+- All chunks are read in one transaction (REPEATABLE READ on Postgres, a
+  read transaction in WAL mode on SQLite, see sqlite_mode.py), so the backup
+  is a consistent snapshot that doesn't block writes
+
+Restore
+- Tables are loaded in foreign key order (users, genres, movies, archived
+  movies), each chunk in its own transaction: COPY FROM STDIN on Postgres,
+  executemany() on SQLite. A chunk whose checksum or row count doesn't match
+  is rolled back
+- --resume continues an interrupted restore: the chunks up to the highest
+  id already in a table were committed and are skipped
+- Into empty tables only, or --clean to empty them first (and genre_stats
+  and the similar titles that depend on them)
+- Afterwards genre_stats is recomputed and, on Postgres, the id sequences
+  are moved past the restored ids
+
+Usage, on the database CATALOG_DATABASE_URL points at
+    python backup.py dump <dir> [--chunk-rows N] [--level 1-9]
+    python backup.py restore <dir> [--resume | --clean]
+Run similar_movies.py and snapshot.py with --full after a restore
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import time
+
+from sqlalchemy import (
+    Float,
+    func,
+    Integer,
+    LargeBinary,
+    select
+)
+from sqlalchemy.orm import sessionmaker
+
+from database_setup import (
+    Base,
+    DATABASE_URL,
+    engine,
+    Genre,
+    Movie,
+    MovieArchive,
+    MovieSimilar,
+    SimilarBuild,
+    User
+)
+import genre_stats
+import sqlite_mode
+
+FORMAT = 'catalog-backup'
+VERSION = 1
+# Rows per chunk, and per restore transaction
+CHUNK_ROWS = 100000
+# gzip level: 1 keeps up with the disk, higher levels mostly cost CPU
+COMPRESS_LEVEL = 1
+BLOCK = 1024 * 1024
+
+# In foreign key order
+TABLES = [User.__table__, Genre.__table__, Movie.__table__,
+          MovieArchive.__table__]
+# Derived from the backed up tables, emptied by --clean
+DERIVED = [MovieSimilar.__table__, SimilarBuild.__table__]
+
+# COPY text format escaping
+ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+UNESCAPE = re.compile(r'\\(.)')
+UNESCAPED = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+             'v': '\v'}
+
+
+def encode_row(row):
+    return '\t'.join([
+        '\\N' if value is None else
+        value.translate(ESCAPE) if value.__class__ is str else
+        # bytea in hex, with the backslash escaped
+        '\\\\x' + value.hex() if value.__class__ is bytes else str(value)
+        for value in row]) + '\n'
+
+
+def decode_field(field, convert):
+    if field == '\\N':
+        return None
+    if '\\' in field:
+        field = UNESCAPE.sub(lambda m: UNESCAPED.get(m.group(1), m.group(1)),
+                             field)
+    return convert(field)
+
+
+def converter(column):
+    # SQLite is given Python values, Postgres parses the text itself
+    if isinstance(column.type, Integer):
+        return int
+    if isinstance(column.type, Float):
+        return float
+    if isinstance(column.type, LargeBinary):
+        return lambda value: bytes.fromhex(value[2:])
+    return str
+
+
+class HashingFile(object):
+    '''
+        Wraps a binary file, hashing what is written to it.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class RowCounter(object):
+    '''
+        What COPY TO writes into: counts the rows (one per line in the text
+        format) on the way to the compressor.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.rows += data.count(b'\n')
+        return self.f.write(data)
+
+
+def table_sql(dialect, table, columns):
+    quote = dialect.identifier_preparer
+    return '%s (%s)' % (quote.format_table(table),
+                        ', '.join(quote.quote(name) for name in columns))
+
+
+def chunk_bounds(connection, table, chunk_rows):
+    '''
+        Yields the (after, last) id ranges of chunk_rows rows covering table,
+        from its primary key index.
+    '''
+    id_column = table.c.id
+    after = None
+    while True:
+        query = select(id_column)
+        if after is not None:
+            query = query.where(id_column > after)
+        last = connection.execute(query.order_by(id_column)
+                                  .offset(chunk_rows - 1).limit(1)).scalar()
+        if last is None:
+            # The last, smaller chunk
+            query = select(func.max(id_column))
+            if after is not None:
+                query = query.where(id_column > after)
+            last = connection.execute(query).scalar()
+            if last is None:
+                return
+        yield after, last
+        after = last
+
+
+def write_chunk(connection, table, after, last, path, level):
+    '''
+        Writes the rows after < id <= last of table into path.
+
+        Returns
+            rows (int), sha256 (str): Rows written and the file's checksum
+    '''
+    query = select(*table.columns).where(table.c.id <= last)
+    if after is not None:
+        query = query.where(table.c.id > after)
+    sql = str(query.order_by(table.c.id).compile(
+        dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    cursor = connection.connection.cursor()
+
+    with open(path + '.tmp', 'wb') as f:
+        hashing = HashingFile(f)
+        with gzip.GzipFile(fileobj=hashing, mode='wb', compresslevel=level,
+                           mtime=0) as compressed:
+            counter = RowCounter(compressed)
+            if connection.dialect.name == 'postgresql':
+                cursor.copy_expert('COPY (%s) TO STDOUT' % sql, counter,
+                                   size=BLOCK)
+            else:
+                cursor.execute(sql)
+                for rows in iter(lambda: cursor.fetchmany(1000), []):
+                    counter.write(''.join([encode_row(row) for row in rows]))
+    cursor.close()
+    os.replace(path + '.tmp', path)
+    return counter.rows, hashing.sha256.hexdigest()
+
+
+def dump(engine, directory, chunk_rows=CHUNK_ROWS, level=COMPRESS_LEVEL):
+    '''
+        Writes a backup of TABLES into directory.
+
+        Returns
+            manifest (dict): What was written (also in manifest.json)
+    '''
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        'format': FORMAT,
+        'version': VERSION,
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'source': engine.dialect.name,
+        'tables': [],
+    }
+    connection = engine.connect()
+    if engine.dialect.name == 'postgresql':
+        # Every chunk sees the same snapshot
+        connection = connection.execution_options(
+            isolation_level='REPEATABLE READ')
+    try:
+        with connection.begin():
+            for table in TABLES:
+                entry = {'name': table.name, 'rows': 0, 'chunks': []}
+                bounds = chunk_bounds(connection, table, chunk_rows)
+                for number, (after, last) in enumerate(bounds):
+                    name = '%s-%06d.tsv.gz' % (table.name, number)
+                    rows, sha256 = write_chunk(
+                        connection, table, after, last,
+                        os.path.join(directory, name), level)
+                    entry['chunks'].append({
+                        'file': name, 'after': after, 'last': last,
+                        'rows': rows, 'sha256': sha256})
+                    entry['rows'] += rows
+                    print("%s: %d rows" % (name, rows))
+                entry['columns'] = [column.name for column in table.columns]
+                manifest['tables'].append(entry)
+    finally:
+        connection.close()
+
+    path = os.path.join(directory, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT or manifest.get('version') != VERSION:
+        raise ValueError("%s isn't a catalog backup this version reads"
+                         % directory)
+    return manifest
+
+
+def decode_rows(compressed, converters):
+    '''
+        Yields the rows of a decompressed chunk as tuples of Python values.
+    '''
+    text = io.TextIOWrapper(compressed, encoding='utf-8', newline='\n')
+    for line in text:
+        fields = line[:-1].split('\t')
+        yield tuple(decode_field(field, convert)
+                    for field, convert in zip(fields, converters))
+
+
+def load_chunk(raw, dialect, table, columns, path, chunk):
+    '''
+        Loads one chunk in its own transaction, checking its checksum first
+        and its row count before committing.
+    '''
+    if file_sha256(path) != chunk['sha256']:
+        raise ValueError("%s is corrupt (checksum mismatch)" % path)
+    cursor = raw.cursor()
+    try:
+        if dialect.name == 'sqlite':
+            # The driver may leave transactions to us (sqlite_mode.py)
+            cursor.execute('BEGIN IMMEDIATE')
+        with gzip.open(path, 'rb') as compressed:
+            target = table_sql(dialect, table, columns)
+            if dialect.name == 'postgresql':
+                cursor.copy_expert('COPY %s FROM STDIN' % target, compressed,
+                                   size=BLOCK)
+            else:
+                converters = [converter(table.c[name]) for name in columns]
+                cursor.executemany(
+                    'INSERT INTO %s VALUES (%s)' % (
+                        target, ', '.join('?' for _ in columns)),
+                    decode_rows(compressed, converters))
+            rows = cursor.rowcount
+        if rows >= 0 and rows != chunk['rows']:
+            raise ValueError("%s: loaded %d rows, expected %d"
+                             % (path, rows, chunk['rows']))
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def clean(raw, dialect):
+    '''
+        Empties TABLES and what depends on them, in one transaction.
+    '''
+    quote = dialect.identifier_preparer
+    dependents = [table for table in Base.metadata.sorted_tables
+                  if table not in TABLES and
+                  any(key.column.table in TABLES
+                      for key in table.foreign_keys)]
+    doomed = DERIVED + dependents + TABLES[::-1]
+    cursor = raw.cursor()
+    try:
+        if dialect.name == 'postgresql':
+            cursor.execute('TRUNCATE %s' % ', '.join(
+                quote.format_table(table) for table in doomed))
+        else:
+            cursor.execute('BEGIN IMMEDIATE')
+            for table in doomed:
+                cursor.execute('DELETE FROM %s' % quote.format_table(table))
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def max_id(raw, dialect, table):
+    cursor = raw.cursor()
+    try:
+        cursor.execute('SELECT max(id) FROM %s'
+                       % dialect.identifier_preparer.format_table(table))
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        raw.rollback()
+
+
+def reset_sequences(raw, dialect):
+    '''
+        Moves the Postgres id sequences past the restored ids.
+    '''
+    cursor = raw.cursor()
+    try:
+        for table in TABLES:
+            if table.c.id.autoincrement is False:
+                # Ids copied from another table (movie_archive)
+                continue
+            name = dialect.identifier_preparer.format_table(table)
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%%s, 'id'), "
+                "coalesce(max(id), 0) + 1, false) FROM %s" % name, (name,))
+        raw.commit()
+    finally:
+        cursor.close()
+
+
+def restore(engine, directory, resume=False, clean_first=False):
+    '''
+        Loads a backup written by dump() into engine's database.
+
+        Returns
+            loaded (int): Rows loaded
+    '''
+    manifest = read_manifest(directory)
+    entries = dict((entry['name'], entry) for entry in manifest['tables'])
+    dialect = engine.dialect
+    Base.metadata.create_all(engine)
+    raw = engine.raw_connection()
+    loaded = 0
+    try:
+        if clean_first:
+            clean(raw, dialect)
+        for table in TABLES:
+            entry = entries.get(table.name)
+            if entry is None:
+                continue
+            unknown = set(entry['columns']) - set(table.c.keys())
+            if unknown:
+                raise ValueError("%s has unknown columns %s"
+                                 % (table.name, sorted(unknown)))
+            done = max_id(raw, dialect, table)
+            if done is not None and not resume:
+                raise ValueError("%s isn't empty, restore with --resume or "
+                                 "--clean" % table.name)
+            for chunk in entry['chunks']:
+                # Chunks are committed whole and in id order
+                if done is not None and chunk['last'] <= done:
+                    continue
+                load_chunk(raw, dialect, table, entry['columns'],
+                           os.path.join(directory, chunk['file']), chunk)
+                loaded += chunk['rows']
+                print("%s: %d rows" % (chunk['file'], chunk['rows']))
+        if dialect.name == 'postgresql':
+            reset_sequences(raw, dialect)
+    finally:
+        raw.close()
+
+    session = sessionmaker(bind=engine)()
+    try:
+        genre_stats.repair(session)
+    finally:
+        session.close()
+    return loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Back up or restore users, genres and movies')
+    parser.add_argument('command', choices=['dump', 'restore'])
+    parser.add_argument('directory')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--level', type=int, default=COMPRESS_LEVEL,
+                        help='gzip level of a dump (1-9)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted restore')
+    parser.add_argument('--clean', action='store_true',
+                        help='empty the tables before restoring')
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.command == 'dump':
+        # On SQLite read through a read-only connection, leaving the write
+        # lock to the app
+        source = (sqlite_mode.reader(DATABASE_URL)
+                  if sqlite_mode.applies(DATABASE_URL) else engine)
+        manifest = dump(source, args.directory, args.chunk_rows, args.level)
+        rows = sum(entry['rows'] for entry in manifest['tables'])
+    else:
+        rows = restore(engine, args.directory, args.resume, args.clean)
+    elapsed = time.time() - start
+    print("%d rows in %.1f s (%.0f rows/s)" % (rows, elapsed,
+                                               rows / max(elapsed, 1e-9)))
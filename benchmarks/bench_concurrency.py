@@ -0,0 +1,99 @@
+"""
+Connections-per-worker benchmark for the WSGI and ASGI serving modes
+
+Opens an increasing number of concurrent connections against a read route
+and reports throughput and latency at each level. The interesting number is
+how many connections ONE worker can keep in flight before latency falls off a
+cliff: under mod_wsgi that's the thread count, under asgi.py it's bounded by
+the DB pool and the event loop instead
+
+Usage (requires httpx)
+    # current deployment: mod_wsgi, 1 process x 15 threads
+    python benchmarks/bench_concurrency.py http://localhost/catalog.json \\
+        --workers 1 --label wsgi
+    # async mode: one uvicorn worker
+    uvicorn catalog.asgi:app --port 8001 --workers 1
+    python benchmarks/bench_concurrency.py http://localhost:8001/catalog.json \\
+        --workers 1 --label asgi
+
+Run both against the same Postgres so the DB waits are real
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def run_level(url, concurrency, duration):
+    '''
+        Keeps `concurrency` requests in flight for `duration` seconds.
+
+        Returns
+            latencies (list): Seconds per successful request
+            errors (int): Failed or non-200 requests
+    '''
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    if response.status_code == 200:
+                        latencies.append(time.perf_counter() - start)
+                    else:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors
+
+
+async def main(args):
+    print('%-6s %8s %9s %9s %9s %7s' % ('label', 'conns', 'req/s', 'p50 ms',
+                                        'p99 ms', 'errors'))
+    sustained = 0
+    for concurrency in args.levels:
+        latencies, errors = await run_level(args.url, concurrency,
+                                            args.duration)
+        if not latencies:
+            print('%-6s %8d %9s %9s %9s %7d' % (args.label, concurrency, '-',
+                                                '-', '-', errors))
+            continue
+        p99 = percentile(latencies, 0.99) * 1000
+        print('%-6s %8d %9.0f %9.1f %9.1f %7d' % (
+            args.label, concurrency, len(latencies) / args.duration,
+            percentile(latencies, 0.50) * 1000, p99, errors))
+        if p99 <= args.p99_budget and not errors:
+            sustained = concurrency
+
+    print('\n%s: %d connections per worker within a %.0f ms p99 budget'
+          % (args.label, sustained // args.workers, args.p99_budget))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('url')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes serving url')
+    parser.add_argument('--label', default='run')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per concurrency level')
+    parser.add_argument('--levels', type=int, nargs='+',
+                        default=[1, 8, 16, 32, 64, 128, 256, 512])
+    parser.add_argument('--p99-budget', type=float, default=250,
+                        help='p99 latency (ms) a level must stay under')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,179 @@
+"""
+Memory per worker and throughput: preloaded pre-fork workers vs not
+
+Starts serve.py (gunicorn) twice on a scratch port, once with the app
+preloaded in the master (CATALOG_PRELOAD=1) and once imported by every
+worker (CATALOG_PRELOAD=0, which is what mod_wsgi daemon processes do), and
+for each reports
+- throughput and latency of a read route under concurrent load
+- per worker: PSS (private memory plus its share of shared pages) and
+  private memory, from /proc/<pid>/smaps_rollup (Linux), after the load
+
+The current Apache setup can be measured the same way
+    python benchmarks/bench_prefork.py --external http://localhost/ \\
+        --match 'wsgi:catalog'
+(give the WSGIDaemonProcess a display-name=%{GROUP} so the processes can be
+found by name)
+
+Usage
+    python benchmarks/bench_prefork.py [--workers 4] [--threads 4]
+        [--duration 10] [--concurrency 16] [--path /catalog.json]
+Uses the database configured by CATALOG_DATABASE_URL
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVE = os.path.join(os.path.dirname(HERE), 'serve.py')
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def memory(pid):
+    '''
+        Returns
+            pss, private (float): MB, from /proc/<pid>/smaps_rollup
+    '''
+    values = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024.0
+    return (values.get('Pss', 0),
+            values.get('Private_Clean', 0) + values.get('Private_Dirty', 0))
+
+
+def processes(parent=None, match=None):
+    '''
+        Finds worker processes, by parent pid or by a command line match.
+    '''
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open('/proc/%s/cmdline' % name, 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ').decode()
+        except (IOError, IndexError, ValueError):
+            continue
+        if ((parent is not None and ppid == parent) or
+                (match is not None and match in cmdline)):
+            pids.append(int(name))
+    return pids
+
+
+def load(url, concurrency, duration):
+    '''
+        Keeps `concurrency` requests in flight for `duration` seconds.
+
+        Returns
+            latencies (list): Seconds per successful request
+            errors (int): Failed or non-200 requests
+    '''
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = requests.Session()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = client.get(url, timeout=30)
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[0] += 1
+            except requests.RequestException:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def report(label, latencies, errors, duration, pids):
+    print("%-12s %7.0f req/s  p50 %6.1f ms  p99 %6.1f ms  errors %d" % (
+        label, len(latencies) / duration,
+        percentile(latencies, 0.5) * 1000 if latencies else 0,
+        percentile(latencies, 0.99) * 1000 if latencies else 0, errors))
+    usage = [memory(pid) for pid in pids]
+    for pid, (pss, private) in zip(pids, usage):
+        print("%12s worker %-7d PSS %6.1f MB  private %6.1f MB" % (
+            '', pid, pss, private))
+    if usage:
+        print("%12s %d workers    PSS %6.1f MB  private %6.1f MB  (total)" % (
+            '', len(usage), sum(u[0] for u in usage),
+            sum(u[1] for u in usage)))
+
+
+def wait_ready(base, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(base + '/ready', timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("%s didn't get ready" % base)
+
+
+def run_server(args, preload):
+    env = dict(os.environ,
+               CATALOG_BIND='127.0.0.1:%d' % args.port,
+               CATALOG_WORKERS=str(args.workers),
+               CATALOG_THREADS=str(args.threads),
+               CATALOG_PRELOAD='1' if preload else '0',
+               CATALOG_SECRET_KEY=os.environ.get('CATALOG_SECRET_KEY',
+                                                 'bench'))
+    server = subprocess.Popen([sys.executable, SERVE], env=env)
+    base = 'http://127.0.0.1:%d' % args.port
+    try:
+        wait_ready(base)
+        # Give every worker time to finish booting
+        time.sleep(2)
+        latencies, errors = load(base + args.path, args.concurrency,
+                                 args.duration)
+        report('preload' if preload else 'no-preload', latencies, errors,
+               args.duration, processes(parent=server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--path', default='/catalog.json')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--external', help='benchmark a running server')
+    parser.add_argument('--match', help='command line of its workers')
+    args = parser.parse_args()
+
+    if args.external:
+        url = args.external.rstrip('/') + args.path
+        latencies, errors = load(url, args.concurrency, args.duration)
+        report('external', latencies, errors, args.duration,
+               processes(match=args.match) if args.match else [])
+    else:
+        for preload in (True, False):
+            run_server(args, preload)
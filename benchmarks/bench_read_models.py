@@ -0,0 +1,102 @@
+"""
+Memory and time benchmark: ORM instances vs read models (read_models.py)
+
+Loads every movie of one big genre the way show_movies/movies_json do, once
+through the ORM (session.query(Movie), then Movie.serialize) and once through
+read_models.get_movies, and reports per path
+- load: seconds to run the query and build the objects
+- serialize: seconds to turn them into the JSON dicts
+- peak: peak memory allocated while loading (tracemalloc)
+- kept: memory still held by the loaded objects (and the session) after
+
+Usage
+    python benchmarks/bench_read_models.py [--movies 100000] [--url URL]
+- Without --url it builds a scratch SQLite database in a temp directory
+- With --url it uses that database, adding the benchmark genre only if it
+  isn't there yet (named 'bench-<movies>')
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(label, load, serialize):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    objects = load()
+    load_seconds = time.perf_counter() - start
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    serialize(objects)
+    serialize_seconds = time.perf_counter() - start
+
+    print("%-12s %8d rows  load %7.3f s  serialize %7.3f s  "
+          "peak %7.1f MB  kept %7.1f MB" % (
+              label, len(objects), load_seconds, serialize_seconds,
+              peak / 2.0 ** 20, kept / 2.0 ** 20))
+    return objects
+
+
+def main(args):
+    from sqlalchemy.orm import sessionmaker
+
+    import read_models
+    from database_setup import Genre, Movie, User, engine
+
+    DBSession = sessionmaker(bind=engine)
+    session = DBSession()
+    name = 'bench-%d' % args.movies
+    genre = session.query(Genre).filter_by(name=name).first()
+    if genre is None:
+        print("Creating genre %s with %d movies..." % (name, args.movies))
+        user = User(name='Bench', email='bench-%d@example.com' % time.time())
+        genre = Genre(name=name, user=user)
+        session.add(genre)
+        session.flush()
+        session.bulk_insert_mappings(Movie, [
+            {'name': 'Movie %d' % i, 'genre_id': genre.id,
+             'user_id': user.id,
+             'description': 'A description of movie number %d' % i}
+            for i in range(args.movies)])
+        session.commit()
+    genre_id = genre.id
+    session.close()
+
+    for _ in range(args.repeat):
+        # Fresh sessions, so neither path gets the other's identity map
+        orm_session = DBSession()
+        measure('orm',
+                lambda: orm_session.query(Movie).filter_by(
+                    genre_id=genre_id).all(),
+                lambda movies: [i.serialize for i in movies])
+        orm_session.close()
+
+        view_session = DBSession()
+        measure('read_models',
+                lambda: read_models.get_movies(view_session, genre_id),
+                lambda movies: [i.serialize for i in movies])
+        view_session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--movies', type=int, default=100000)
+    parser.add_argument('--url', help='database URL (default: scratch SQLite)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # database_setup.py connects on import, so point it somewhere first
+    if args.url is None:
+        args.url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['CATALOG_DATABASE_URL'] = args.url
+    sys.path.insert(0, os.path.dirname(HERE))
+    main(args)
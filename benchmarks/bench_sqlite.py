@@ -0,0 +1,173 @@
+"""
+Concurrent read/write benchmark: tuned SQLite vs default SQLite vs Postgres
+
+Fills a scratch database with movies, then runs a mixed workload from
+several processes with several threads each (like mod_wsgi daemons): reads
+of one movie by id (read_models.MOVIE_BY_ID, what solo_json runs) and, for a
+fraction of the operations, a write transaction bumping a movie's version.
+For every setup it reports operations per second, read and write latency
+and the errors ('database is locked') the clients got
+- default: create_engine() on the file, as the app did before sqlite_mode.py
+- tuned: sqlite_mode.py's writer and read-only reader engines
+- postgres: with --postgres URL (tables are created there, movies added)
+
+Usage
+    python benchmarks/bench_sqlite.py [--movies 100000] [--processes 4]
+        [--threads 4] [--duration 10] [--writes 0.05] [--postgres URL]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def engines(setup, url):
+    '''
+        Returns
+            writer, reader (Engine): Where the writes and the reads go
+    '''
+    from sqlalchemy import create_engine
+    import sqlite_mode
+
+    if setup == 'tuned':
+        return sqlite_mode.writer(url), sqlite_mode.reader(url)
+    engine = create_engine(url)
+    return engine, engine
+
+
+def fill(url, movies):
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.orm import sessionmaker
+    from database_setup import Base, Genre, Movie, User
+
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    user = session.query(User).filter_by(
+        email='bench-sqlite@example.com').first()
+    if user is None:
+        user = User(name='Bench', email='bench-sqlite@example.com')
+        session.add(Genre(name='bench-sqlite', user=user))
+        session.commit()
+    genre = session.query(Genre).filter_by(name='bench-sqlite').one()
+    have = session.execute(select(func.count(Movie.id))
+                           .where(Movie.genre_id == genre.id)).scalar()
+    rows = [{'name': 'Movie %d' % i, 'description': 'Description %d ' % i * 5,
+             'genre_id': genre.id, 'user_id': user.id, 'version': 1}
+            for i in range(have, movies)]
+    for start in range(0, len(rows), 10000):
+        session.execute(Movie.__table__.insert(), rows[start:start + 10000])
+    session.commit()
+    ids = session.execute(select(Movie.id).where(
+        Movie.genre_id == genre.id)).scalars().all()
+    session.close()
+    engine.dispose()
+    return ids
+
+
+def client(setup, url, ids, args, results):
+    '''
+        One process: args.threads threads running operations until the
+        duration is over, results go back through a queue.
+    '''
+    from sqlalchemy import update
+    import read_models
+    from database_setup import Movie
+
+    writer, reader = engines(setup, url)
+    deadline = time.perf_counter() + args.duration
+    reads, writes, errors = [], [], []
+
+    def worker():
+        while time.perf_counter() < deadline:
+            movie_id = random.choice(ids)
+            start = time.perf_counter()
+            try:
+                if random.random() < args.writes:
+                    with writer.begin() as connection:
+                        connection.execute(
+                            update(Movie).where(Movie.id == movie_id)
+                            .values(version=Movie.version + 1))
+                    writes.append(time.perf_counter() - start)
+                else:
+                    with reader.connect() as connection:
+                        connection.execute(read_models.MOVIE_BY_ID,
+                                           {'movie_id': movie_id}).first()
+                    reads.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(str(e).split('\n')[0][:80])
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((reads, writes, errors))
+
+
+def run(setup, url, ids, args):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client,
+                                         args=(setup, url, ids, args, results))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    reads, writes, errors = [], [], []
+    for _ in processes:
+        r, w, e = results.get()
+        reads += r
+        writes += w
+        errors += e
+    for process in processes:
+        process.join()
+
+    print("%-9s %8.0f reads/s  p50 %6.2f ms  p99 %7.2f ms" % (
+        setup, len(reads) / args.duration, percentile(reads, 0.5) * 1000,
+        percentile(reads, 0.99) * 1000))
+    print("%-9s %8.0f writes/s p50 %6.2f ms  p99 %7.2f ms  errors %d" % (
+        '', len(writes) / args.duration, percentile(writes, 0.5) * 1000,
+        percentile(writes, 0.99) * 1000, len(errors)))
+    for error in sorted(set(errors))[:3]:
+        print("%-9s   %s" % ('', error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--movies', type=int, default=100000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--writes', type=float, default=0.05,
+                        help='fraction of operations that write')
+    parser.add_argument('--postgres', help='also benchmark this database')
+    args = parser.parse_args()
+
+    # database_setup.py connects on import (and would switch a SQLite file
+    # to WAL), so point it somewhere else first
+    scratch = tempfile.mkdtemp()
+    sqlite_url = 'sqlite:///' + os.path.join(scratch, 'bench.db')
+    os.environ['CATALOG_DATABASE_URL'] = (
+        args.postgres or 'sqlite:///' + os.path.join(scratch, 'setup.db'))
+    sys.path.insert(0, os.path.dirname(HERE))
+    multiprocessing.set_start_method('fork')
+
+    ids = fill(sqlite_url, args.movies)
+    # The default setup first: the tuned one leaves the file in WAL mode
+    run('default', sqlite_url, ids, args)
+    run('tuned', sqlite_url, ids, args)
+    if args.postgres:
+        run('postgres', args.postgres, fill(args.postgres, args.movies),
+            args)
@@ -0,0 +1,132 @@
+"""
+Per-query overhead benchmark for the hot read queries
+
+Runs each query shape of the read routes (genre by id, movies by genre, movie
+by id, user by id, user id by email) many times in three ways
+- orm: session.query(...).filter_by(...) as the routes used to
+- inline: a select() built on every call, as read_models.py first did
+- declared: the pre-declared statements of read_models.py, where only the
+  bind values change
+and reports microseconds per query. The tables are tiny on purpose so the
+numbers are mostly Python overhead: building the statement, computing its
+cache key, compiling (or finding it in the compiled cache), and the driver
+
+Usage
+    python benchmarks/bench_statements.py [--iterations 5000] [--url URL]
+Without --url it builds a scratch SQLite database in a temp directory
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def timed(iterations, query):
+    query()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        query()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main(args):
+    from sqlalchemy import select
+    from sqlalchemy.orm import sessionmaker
+
+    import read_models
+    from read_models import GenreView, MovieView, UserView
+    from database_setup import Genre, Movie, User, engine
+
+    session = sessionmaker(bind=engine)()
+    user = session.query(User).filter_by(
+        email='bench-statements@example.com').first()
+    if user is None:
+        user = User(name='Bench', email='bench-statements@example.com')
+        genre = Genre(name='bench-statements', user=user)
+        session.add(genre)
+        session.flush()
+        session.bulk_insert_mappings(Movie, [
+            {'name': 'Movie %d' % i, 'genre_id': genre.id, 'user_id': user.id,
+             'description': 'Description %d' % i} for i in range(10)])
+        session.commit()
+    genre = session.query(Genre).filter_by(user_id=user.id).first()
+    movie = session.query(Movie).filter_by(genre_id=genre.id).first()
+    ids = {'genre_id': genre.id, 'movie_id': movie.id, 'user_id': user.id,
+           'email': user.email}
+    session.close()
+
+    shapes = [
+        ('genre by id', {
+            'orm': lambda s: s.query(Genre).filter_by(
+                id=ids['genre_id']).one(),
+            'inline': lambda s: GenreView._make(s.execute(
+                select(*read_models.GENRE_COLUMNS)
+                .where(Genre.id == ids['genre_id'])).one()),
+            'declared': lambda s: read_models.get_genre(s, ids['genre_id']),
+        }),
+        ('movies by genre', {
+            'orm': lambda s: s.query(Movie).filter_by(
+                genre_id=ids['genre_id']).all(),
+            'inline': lambda s: [MovieView._make(row) for row in s.execute(
+                select(*read_models.MOVIE_COLUMNS)
+                .join(Genre, Movie.genre_id == Genre.id)
+                .where(Movie.genre_id == ids['genre_id']))],
+            'declared': lambda s: read_models.get_movies(
+                s, ids['genre_id']),
+        }),
+        ('movie by id', {
+            'orm': lambda s: s.query(Movie).filter_by(
+                id=ids['movie_id']).one(),
+            'inline': lambda s: MovieView._make(s.execute(
+                select(*read_models.MOVIE_COLUMNS)
+                .outerjoin(Genre, Movie.genre_id == Genre.id)
+                .where(Movie.id == ids['movie_id'])).one()),
+            'declared': lambda s: read_models.get_movie(s, ids['movie_id']),
+        }),
+        ('user by id', {
+            'orm': lambda s: s.query(User).filter_by(
+                id=ids['user_id']).one(),
+            'inline': lambda s: UserView._make(s.execute(
+                select(*read_models.USER_COLUMNS)
+                .where(User.id == ids['user_id'])).one()),
+            'declared': lambda s: read_models.get_user(s, ids['user_id']),
+        }),
+        ('user id by email', {
+            'orm': lambda s: s.query(User).filter_by(
+                email=ids['email']).one().id,
+            'inline': lambda s: s.execute(
+                select(User.id).where(User.email == ids['email'])).scalar(),
+            'declared': lambda s: read_models.get_user_id(s, ids['email']),
+        }),
+    ]
+
+    print("%-18s %10s %10s %10s   (us per query)" % (
+        'query', 'orm', 'inline', 'declared'))
+    for name, ways in shapes:
+        timings = []
+        for way in ('orm', 'inline', 'declared'):
+            session = sessionmaker(bind=engine)()
+            # A fresh identity map per query, like a request gets
+            query = ways[way]
+            timings.append(timed(args.iterations,
+                                 lambda: (query(session),
+                                          session.expunge_all())))
+            session.close()
+        print("%-18s %10.1f %10.1f %10.1f" % ((name,) + tuple(timings)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--url', help='database URL (default: scratch SQLite)')
+    args = parser.parse_args()
+
+    # database_setup.py connects on import, so point it somewhere first
+    if args.url is None:
+        args.url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['CATALOG_DATABASE_URL'] = args.url
+    sys.path.insert(0, os.path.dirname(HERE))
+    main(args)
@@ -0,0 +1,168 @@
+"""
+This file keeps the change log behind /catalog/changes.json
+
+Partners mirroring the catalog used to re-download every genre on every
+poll. Instead every movie write also appends a row to movie_change in the
+SAME transaction (see movie_writes.py), and clients ask for the changes
+after the last version they saw
+
+Syncing
+1. GET /catalog/changes.json           -> current version, no changes
+2. Download the full catalog once (catalog.json + movies.json per genre)
+3. GET /catalog/changes.json?since=<version>[&limit=N] repeatedly, applying
+   the changes and keeping the returned version; follow 'more' to page
+- Created and edited movies come back with their current data
+- Deleted movies come back as tombstones ({"id": 17, "deleted": true})
+- A movie changed several times within a page only shows up once
+- Archived movies (movie_archive.py) come back as tombstones, they left
+  the genre lists; moved back they come back as upserts
+
+Versions are handed out in commit order: on Postgres writers take a
+transaction level advisory lock before logging, so a version can never
+become visible after a higher one (SQLite only has one writer anyway)
+"""
+import datetime
+
+from sqlalchemy import func, literal, select, text
+
+from database_setup import Genre, Movie, MovieChange
+
+table = MovieChange.__table__
+
+# Arbitrary key for pg_advisory_xact_lock, shared by all movie writers
+LOCK_KEY = 0x6d6f766965
+
+MAX_LIMIT = 1000
+
+
+def _serialize_writers(session):
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                        {'key': LOCK_KEY})
+
+
+def record(session, changes):
+    '''
+        Logs movie changes inside the caller's transaction (the caller
+        commits). Call it as the last statement before the commit to keep
+        the lock short.
+
+        Params
+            session (Session): Session of the write being logged
+            changes (list): (movie_id, genre_id, op) tuples, op being
+                'upsert' or 'delete'
+    '''
+    if not changes:
+        return
+    _serialize_writers(session)
+    now = datetime.datetime.utcnow()
+    session.execute(table.insert(), [
+        {'movie_id': movie_id, 'genre_id': genre_id, 'op': op,
+         'changed_at': now}
+        for movie_id, genre_id, op in changes])
+
+
+def record_movie(session, movie_id, op):
+    '''
+        Logs a change for a movie without fetching it first (its genre is
+        copied over in an INSERT ... SELECT). For deletes call it before the
+        DELETE runs.
+    '''
+    _serialize_writers(session)
+    session.execute(table.insert().from_select(
+        ['movie_id', 'genre_id', 'op', 'changed_at'],
+        select(Movie.id, Movie.genre_id, literal(op),
+               literal(datetime.datetime.utcnow()))
+        .where(Movie.id == movie_id)))
+
+
+def current_version(session):
+    return session.execute(select(func.max(table.c.version))).scalar() or 0
+
+
+def changes_since(session, since, limit=MAX_LIMIT):
+    '''
+        Gets one page of changes after a version.
+
+        Params
+            session (Session): Database session to read through
+            since (int): Last version the client has applied
+            limit (int): Log entries to read at most
+
+        Returns
+            changes (list): Movie dicts (as Movie.serialize plus genre_id) or
+                tombstones, oldest first
+            version (int): Version to pass as since next time
+            more (bool): Whether more changes are waiting
+    '''
+    limit = max(1, min(limit, MAX_LIMIT))
+    rows = session.execute(
+        select(table.c.version, table.c.movie_id, table.c.op)
+        .where(table.c.version > since)
+        .order_by(table.c.version)
+        .limit(limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], since, False
+
+    # Only the last change per movie matters to the client
+    latest = {}
+    for version, movie_id, op in rows:
+        latest[movie_id] = (version, op)
+
+    upserted = [movie_id for movie_id, (_, op) in latest.items()
+                if op == 'upsert']
+    movies = {}
+    if upserted:
+        for movie, genre_name in session.execute(
+                select(Movie, Genre.name)
+                .join(Genre, Movie.genre_id == Genre.id)
+                .where(Movie.id.in_(upserted))):
+            movies[movie.id] = {
+                'id': movie.id,
+                'name': movie.name,
+                'description': movie.description,
+                'genre': genre_name,
+                'genre_id': movie.genre_id
+            }
+
+    changes = []
+    for movie_id, (version, op) in sorted(latest.items(),
+                                          key=lambda item: item[1][0]):
+        # A movie missing here was deleted after this page's entries, its
+        # tombstone is in a later page
+        if op == 'upsert' and movie_id in movies:
+            changes.append(dict(movies[movie_id], version=version))
+        elif op == 'delete':
+            changes.append({'id': movie_id, 'deleted': True,
+                            'version': version})
+
+    return changes, rows[-1][0], more
+
+
+def touched_since(session, since):
+    '''
+        Sums up everything that changed after a version, for consumers that
+        only need to know what to refresh (e.g. snapshot.py).
+
+        Returns
+            version (int): Latest version covered
+            upserted (dict): movie_id -> genre_id of created/edited movies
+            deleted (dict): movie_id -> genre_id of deleted movies
+    '''
+    upserted, deleted = {}, {}
+    version = since
+    rows = session.execute(
+        select(table.c.version, table.c.movie_id, table.c.genre_id,
+               table.c.op)
+        .where(table.c.version > since)
+        .order_by(table.c.version))
+    for version, movie_id, genre_id, op in rows:
+        if op == 'delete':
+            upserted.pop(movie_id, None)
+            deleted[movie_id] = genre_id
+        else:
+            deleted.pop(movie_id, None)
+            upserted[movie_id] = genre_id
+    return version, upserted, deleted
@@ -0,0 +1,221 @@
+"""
+This file compresses HTML and JSON responses on the way out
+
+CompressionMiddleware wraps the WSGI app (app.wsgi_app) and
+- Picks brotli (when the brotli package is installed) or gzip from the
+  request's Accept-Encoding, honouring q=0 (a coding's own q=0 wins over
+  '*')
+- Only compresses text types (HTML, JSON, CSS, JS, ...) and never touches a
+  response that already has a Content-Encoding (e.g. the precompressed
+  assets from static_assets.py)
+- Leaves bodies smaller than min_size alone, compression doesn't pay off there
+- Works on streamed responses: the body is compressed chunk by chunk and
+  flushed as it goes, nothing is buffered beyond the first min_size bytes
+- Adds 'Vary: Accept-Encoding' to every compressible response, compressed or
+  not, so shared caches keep the variants apart
+
+Settings (environment variables)
+    CATALOG_COMPRESS_MIN_SIZE   smallest body worth compressing (500 bytes)
+    CATALOG_COMPRESS_LEVEL      gzip level 1-9 (6), brotli quality 0-11 (4)
+"""
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+MIN_SIZE = int(os.environ.get('CATALOG_COMPRESS_MIN_SIZE', '500'))
+LEVEL = os.environ.get('CATALOG_COMPRESS_LEVEL')
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+
+def accepted_encodings(header):
+    '''
+        Parses an Accept-Encoding header.
+
+        Returns
+            qualities (dict): Coding -> q value for every coding listed,
+                q=0 ones (refused) included
+    '''
+    qualities = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        coding = coding.strip().lower()
+        if coding:
+            qualities[coding] = quality
+    return qualities
+
+
+def is_accepted(qualities, coding):
+    '''
+        Returns
+            accepted (bool): Whether coding may be used, its own q value
+                wins over the '*' one
+    '''
+    return qualities.get(coding, qualities.get('*', 0)) > 0
+
+
+class GzipStream(object):
+    def __init__(self, level):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # Z_SYNC_FLUSH pushes out everything so far, so a streamed chunk
+        # reaches the client without waiting for the next one
+        return (self.compressor.compress(data) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream(object):
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class CompressionMiddleware(object):
+    def __init__(self, app, min_size=MIN_SIZE, level=LEVEL):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = int(level) if level is not None else 6
+        self.brotli_quality = int(level) if level is not None else 4
+
+    def choose_encoding(self, environ):
+        qualities = accepted_encodings(
+            environ.get('HTTP_ACCEPT_ENCODING', ''))
+        # brotli only when asked for by name, '*' alone gets gzip
+        if (brotli is not None and 'br' in qualities and
+                is_accepted(qualities, 'br')):
+            return 'br'
+        if is_accepted(qualities, 'gzip'):
+            return 'gzip'
+        return None
+
+    def new_stream(self, encoding):
+        if encoding == 'br':
+            return BrotliStream(min(self.brotli_quality, 11))
+        return GzipStream(min(self.gzip_level, 9))
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        state = {}
+        # Bodies passed to the legacy write() callable, sent before the rest
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            # Hold on to the headers until we know whether we compress
+            state['status'] = status
+            state['headers'] = headers
+            state['exc_info'] = exc_info
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        try:
+            for chunk in self.respond(environ, encoding, state, written,
+                                      app_iter, start_response):
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def respond(self, environ, encoding, state, written, app_iter,
+                start_response):
+        body = iter(app_iter)
+        # start_response is only called lazily by Flask/Werkzeug, pull the
+        # first chunk so the headers are known
+        first = []
+        while 'status' not in state:
+            try:
+                first.append(next(body))
+            except StopIteration:
+                break
+
+        status = state['status']
+        headers = [(k, v) for k, v in state['headers']]
+        names = dict((k.lower(), v) for k, v in headers)
+
+        content_type = names.get('content-type', '').lower()
+        compressible = (content_type.startswith(COMPRESSIBLE_TYPES) and
+                        'content-encoding' not in names and
+                        int(status.split(' ', 1)[0]) not in (204, 206, 304) and
+                        environ.get('REQUEST_METHOD') != 'HEAD')
+
+        if compressible:
+            vary = names.get('vary', '')
+            if vary.strip() != '*' and 'accept-encoding' not in vary.lower():
+                headers = [(k, v) for k, v in headers if k.lower() != 'vary']
+                headers.append(('Vary', vary + ', Accept-Encoding'
+                                if vary else 'Accept-Encoding'))
+
+        length = names.get('content-length')
+        if (not compressible or encoding is None or
+                (length is not None and int(length) < self.min_size)):
+            start_response(status, headers, state['exc_info'])
+            for chunk in written + first:
+                yield chunk
+            for chunk in body:
+                yield chunk
+            return
+
+        # Streamed (or large) body: collect up to min_size bytes before
+        # deciding, so tiny streamed bodies are left alone too
+        pending = written + first
+        size = sum(len(chunk) for chunk in pending)
+        exhausted = False
+        while size < self.min_size:
+            try:
+                chunk = next(body)
+            except StopIteration:
+                exhausted = True
+                break
+            pending.append(chunk)
+            size += len(chunk)
+
+        if exhausted and size < self.min_size:
+            start_response(status, headers, state['exc_info'])
+            for chunk in pending:
+                yield chunk
+            return
+
+        headers = [(k, v) for k, v in headers
+                   if k.lower() != 'content-length']
+        headers.append(('Content-Encoding', encoding))
+        for i, (k, v) in enumerate(headers):
+            # The compressed bytes differ, so a strong ETag no longer holds
+            if k.lower() == 'etag' and not v.startswith('W/'):
+                headers[i] = (k, 'W/' + v)
+        start_response(status, headers, state['exc_info'])
+
+        stream = self.new_stream(encoding)
+        data = stream.compress(b''.join(pending))
+        if data:
+            yield data
+        for chunk in body:
+            data = stream.compress(chunk)
+            if data:
+                yield data
+        yield stream.finish()
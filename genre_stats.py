@@ -0,0 +1,139 @@
+"""
+This file maintains the per-genre statistics table (genre_stats)
+
+Counting a genre's movies with COUNT(*) on every page view gets slower as the
+genre grows, and the genre list can't show counts at all without one query
+per genre. Instead genre_stats keeps a movie count and last-modified time per
+genre, updated in the SAME transaction as the movie writes (see
+movie_writes.py), so reading a count is a primary key lookup
+
+If the table ever drifts (rows written around the app, a new deployment, ...)
+rebuild it from scratch
+    python genre_stats.py
+"""
+import datetime
+
+from sqlalchemy import bindparam, func, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database_setup import Genre, GenreStats, Movie
+
+table = GenreStats.__table__
+
+# The read queries run on most page views, declared once (see read_models.py)
+COUNTS = select(table.c.genre_id, table.c.movie_count)
+MOVIE_COUNT = select(table.c.movie_count).where(
+    table.c.genre_id == bindparam('genre_id'))
+
+
+def bump(session, deltas):
+    '''
+        Adds to the movie counts of some genres and marks them modified.
+
+        Runs inside the caller's transaction; the caller commits. Genres
+        without a stats row yet get one (run repair() once so those start
+        from the right count).
+
+        Params
+            session (Session): Session of the write being recorded
+            deltas (dict): genre_id -> change in movie count (0 for edits)
+    '''
+    if not deltas:
+        return
+    now = datetime.datetime.utcnow()
+    rows = [{'genre_id': genre_id, 'movie_count': delta, 'last_modified': now}
+            for genre_id, delta in sorted(deltas.items())]
+
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            statement = postgresql.insert(table)
+        else:
+            statement = sqlite.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['genre_id'],
+            set_={'movie_count': table.c.movie_count +
+                  statement.excluded.movie_count,
+                  'last_modified': statement.excluded.last_modified})
+        session.execute(statement, rows)
+    else:
+        for row in rows:
+            session.execute(
+                update(table)
+                .where(table.c.genre_id == row['genre_id'])
+                .values(movie_count=table.c.movie_count + row['movie_count'],
+                        last_modified=now))
+
+
+def touch_movie_genre(session, movie_id, delta=0):
+    '''
+        Bumps the stats of whatever genre a movie is in, without fetching
+        the movie first (the genre is looked up in a subquery).
+    '''
+    session.execute(
+        update(table)
+        .where(table.c.genre_id == select(Movie.genre_id)
+               .where(Movie.id == movie_id).scalar_subquery())
+        .values(movie_count=table.c.movie_count + delta,
+                last_modified=datetime.datetime.utcnow()))
+
+
+def counts(session):
+    '''
+        Returns
+            counts (dict): genre_id -> number of movies
+    '''
+    return dict(session.execute(COUNTS).all())
+
+
+def movie_count(session, genre_id):
+    '''
+        Returns
+            count (int): Number of movies in the genre, 0 if unknown
+    '''
+    return session.execute(MOVIE_COUNT,
+                           {'genre_id': genre_id}).scalar() or 0
+
+
+def repair(session):
+    '''
+        Recomputes every genre's stats from the movie table, in one
+        transaction.
+
+        On Postgres genre_stats is locked first, so movie writes running at
+        the same time wait and then apply their change on top of the fresh
+        count instead of being lost.
+
+        Returns
+            counts (dict): genre_id -> number of movies
+    '''
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text('LOCK TABLE genre_stats IN EXCLUSIVE MODE'))
+        session.execute(table.delete())
+        movie_counts = (
+            select(Genre.id, func.count(Movie.id))
+            .select_from(Genre)
+            .outerjoin(Movie, Movie.genre_id == Genre.id)
+            .group_by(Genre.id)
+        )
+        now = datetime.datetime.utcnow()
+        rows = [{'genre_id': genre_id, 'movie_count': count,
+                 'last_modified': now}
+                for genre_id, count in session.execute(movie_counts)]
+        if rows:
+            session.execute(table.insert(), rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return dict((row['genre_id'], row['movie_count']) for row in rows)
+
+
+if __name__ == '__main__':
+    from sqlalchemy.orm import sessionmaker
+    from database_setup import engine
+
+    result = repair(sessionmaker(bind=engine)())
+    print("Recounted %d genres, %d movies" % (len(result),
+                                              sum(result.values())))
@@ -2,7 +2,8 @@
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Genre, Movie
+from database_setup import Base, Genre, Movie, User
+import genre_stats
 
 """
 SQLAlchemy executes CRUD operations via an interface called a session
@@ -582,3 +583,8 @@ session.add(gone_girl)
 session.commit()
 
 print("Thriller movies added!")
+
+# The movies went in through the ORM, around genre_stats: count them
+genre_stats.repair(session)
+
+print("Genre statistics rebuilt!")
@@ -0,0 +1,286 @@
+"""
+This file moves cold movies out of the movie table into movie_archive
+
+Most titles stop changing after a while, but they stay in the movie table
+forever: every genre page query, index and vacuum of it keeps paying for
+them. Archiving moves movies that haven't been written for a long time into
+movie_archive, a table nothing scans
+- A movie is cold when its last write in the change feed (change_feed.py)
+  is older than CATALOG_ARCHIVE_DAYS days. Movies written before the feed
+  existed have no changes at all: nothing is known about them, so they are
+  kept unless --include-untracked is given. Views aren't tracked, so
+  --genre limits a run to genres known to be dead
+- The first run (while movie_archive is empty) needs an explicit --days
+- Each batch is one transaction: the movies are copied into movie_archive
+  with their name and description compressed (pack()), deleted from movie,
+  taken off their genres' counts in genre_stats and logged in the change
+  feed as deletes (they left the genre lists). On Postgres movies being
+  edited right then are skipped (FOR UPDATE SKIP LOCKED)
+- Archived movies leave the genre pages, the genre counts and the similar
+  titles, but their own page and JSON keep working: read_models.get_movie
+  (and asgi.py) falls back to movie_archive. When its owner edits or
+  deletes one it's moved back into the movie table first (unarchive(),
+  logged as an upsert)
+- Archived movies keep their ids: Postgres sequences never hand an id out
+  twice, and the SQLite movie table uses AUTOINCREMENT for the same reason
+
+Usage, on the database CATALOG_DATABASE_URL points at (e.g. from cron)
+    python movie_archive.py archive [--days N] [--genre ID ...]
+        [--include-untracked] [--limit N] [--dry-run]
+    python movie_archive.py restore MOVIE_ID ...
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+import zlib
+
+from sqlalchemy import delete, func, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from database_setup import Movie, MovieArchive, MovieChange
+import change_feed
+import genre_stats
+
+ARCHIVE_DAYS = int(os.environ.get('CATALOG_ARCHIVE_DAYS', '730'))
+# Movies per transaction
+BATCH_ROWS = 1000
+# Raw deflate (no zlib header or checksum, the row is small), best ratio:
+# archiving happens once, reading is as fast at any level
+LEVEL = 9
+WBITS = -15
+
+table = MovieArchive.__table__
+movies = Movie.__table__
+
+
+def pack(name, description):
+    '''
+        Returns
+            data (bytes): name and description, compressed
+    '''
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS)
+    data = json.dumps([name, description], separators=(',', ':'))
+    return compressor.compress(data.encode('utf-8')) + compressor.flush()
+
+
+def unpack(data):
+    '''
+        Returns
+            name, description (str): What pack() was given
+    '''
+    name, description = json.loads(zlib.decompress(data, WBITS))
+    return name, description
+
+
+def cold_movies(session, cutoff, after, genre_ids, rows,
+                include_untracked=False):
+    '''
+        Returns
+            movies (list): Up to rows movies with an id above after whose
+                last change is older than cutoff, in id order
+    '''
+    last_change = (select(func.max(MovieChange.changed_at))
+                   .where(MovieChange.movie_id == movies.c.id)
+                   .scalar_subquery())
+    cold = last_change < cutoff
+    if include_untracked:
+        cold = or_(cold, last_change.is_(None))
+    query = select(movies).where(cold)
+    if after is not None:
+        query = query.where(movies.c.id > after)
+    if genre_ids:
+        query = query.where(movies.c.genre_id.in_(genre_ids))
+    query = query.order_by(movies.c.id).limit(rows)
+    if session.get_bind().dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+    return session.execute(query).all()
+
+
+def archive(session, days=ARCHIVE_DAYS, genre_ids=None, limit=None,
+            dry_run=False, batch_rows=BATCH_ROWS, include_untracked=False):
+    '''
+        Moves the movies not written in the last days days into
+        movie_archive, batch_rows per transaction.
+
+        Params
+            session (Session): Session on the primary
+            days (int): How long a movie must not have changed
+            genre_ids (list): Only movies of these genres, None for all
+            limit (int): Stop after this many movies, None for no limit
+            dry_run (bool): Only count the movies that would be archived
+            include_untracked (bool): Archive movies without any change
+                feed entry too
+
+        Returns
+            archived (dict): genre_id -> number of movies archived
+    '''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    archived = {}
+    done = 0
+    after = None
+    while limit is None or done < limit:
+        rows = batch_rows if limit is None else min(batch_rows,
+                                                    limit - done)
+        try:
+            batch = cold_movies(session, cutoff, after, genre_ids, rows,
+                                include_untracked)
+            if not batch:
+                session.rollback()
+                break
+            after = batch[-1].id
+            deltas = {}
+            for movie in batch:
+                deltas[movie.genre_id] = deltas.get(movie.genre_id, 0) - 1
+            if not dry_run:
+                now = datetime.datetime.utcnow()
+                session.execute(table.insert(), [
+                    {'id': movie.id, 'genre_id': movie.genre_id,
+                     'user_id': movie.user_id, 'version': movie.version,
+                     'data': pack(movie.name, movie.description),
+                     'archived_at': now}
+                    for movie in batch])
+                session.execute(delete(movies).where(
+                    movies.c.id.in_([movie.id for movie in batch])))
+                genre_stats.bump(session, dict(
+                    (genre_id, delta) for genre_id, delta in deltas.items()
+                    if genre_id is not None))
+                change_feed.record(session, [
+                    (movie.id, movie.genre_id, 'delete') for movie in batch])
+                session.commit()
+            else:
+                session.rollback()
+        except Exception:
+            session.rollback()
+            raise
+        done += len(batch)
+        for genre_id, delta in deltas.items():
+            archived[genre_id] = archived.get(genre_id, 0) - delta
+    return archived
+
+
+def load(session, movie_id):
+    '''
+        Returns
+            movie (Movie): An archived movie as a Movie that isn't added to
+                the session, for pages showing it
+
+        Raises
+            NoResultFound: If the movie isn't archived
+    '''
+    row = session.execute(select(table).where(table.c.id == movie_id)).one()
+    name, description = unpack(row.data)
+    return Movie(id=row.id, name=name, description=description,
+                 genre_id=row.genre_id, user_id=row.user_id,
+                 version=row.version)
+
+
+def unarchive(session, movie_id, user_id=None):
+    '''
+        Moves an archived movie back into the movie table and logs it in
+        the change feed, in one transaction.
+
+        Params
+            session (Session): Session to write through
+            movie_id (int): Id of the movie
+            user_id (int): Only if this user owns it, None for anyone's
+
+        Returns
+            status (str): 'restored', 'not_found' (not archived),
+                'forbidden' (someone else's) or 'conflict' (a movie in the
+                movie table has its id)
+    '''
+    row = session.execute(select(table).where(table.c.id == movie_id)).first()
+    if row is None:
+        return 'not_found'
+    if user_id is not None and row.user_id != user_id:
+        return 'forbidden'
+    try:
+        # Archived rows never change, only the delete decides who restores
+        # it when two requests try at once
+        result = session.execute(delete(table).where(table.c.id == movie_id))
+        if result.rowcount != 1:
+            session.rollback()
+            return 'not_found'
+        name, description = unpack(row.data)
+        try:
+            session.execute(movies.insert().values(
+                id=row.id, name=name, description=description,
+                genre_id=row.genre_id, user_id=row.user_id,
+                version=row.version))
+        except IntegrityError:
+            # A SQLite movie table from before AUTOINCREMENT gave its id to
+            # a new movie, which is the one its pages show now
+            session.rollback()
+            return 'conflict'
+        if row.genre_id is not None:
+            genre_stats.bump(session, {row.genre_id: 1})
+        change_feed.record(session, [(row.id, row.genre_id, 'upsert')])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return 'restored'
+
+
+if __name__ == '__main__':
+    from sqlalchemy.orm import sessionmaker
+    from database_setup import engine
+    from proxy_cache import purge
+
+    parser = argparse.ArgumentParser(
+        description='Archive cold movies or restore archived ones')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    archive_parser = subparsers.add_parser('archive')
+    archive_parser.add_argument('--days', type=int,
+                                help='not written for this many days '
+                                     '(CATALOG_ARCHIVE_DAYS)')
+    archive_parser.add_argument('--genre', type=int, action='append',
+                                help='only this genre (repeatable)')
+    archive_parser.add_argument('--limit', type=int)
+    archive_parser.add_argument('--include-untracked', action='store_true',
+                                help='also movies the change feed has '
+                                     'never seen')
+    archive_parser.add_argument('--dry-run', action='store_true')
+    restore_parser = subparsers.add_parser('restore')
+    restore_parser.add_argument('movie_ids', type=int, nargs='+')
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=engine)()
+    start = time.time()
+    if args.command == 'archive':
+        days = args.days
+        if days is None:
+            # Guard against archiving a whole catalog by accident
+            if session.execute(select(table.c.id).limit(1)).first() is None:
+                parser.error('the first run needs an explicit --days')
+            days = ARCHIVE_DAYS
+        archived = archive(session, days, args.genre, args.limit,
+                           args.dry_run,
+                           include_untracked=args.include_untracked)
+        total = sum(archived.values())
+        verb = 'Would archive' if args.dry_run else 'Archived'
+        print("%s %d movies of %d genres in %.1f s" % (
+            verb, total, len(archived), time.time() - start))
+        genre_ids = list(archived)
+    else:
+        genre_ids = []
+        for movie_id in args.movie_ids:
+            status = unarchive(session, movie_id)
+            if status == 'conflict':
+                print("%d is archived, but a newer movie has its id"
+                      % movie_id)
+                continue
+            if status != 'restored':
+                print("%d isn't archived" % movie_id)
+                continue
+            genre_ids.append(session.execute(
+                select(Movie.genre_id).where(Movie.id == movie_id)).scalar())
+    session.close()
+    # The genre pages and counts changed, the movie pages didn't (run
+    # snapshot.py for the static export)
+    if genre_ids and not getattr(args, 'dry_run', False):
+        purge(['genres'] + ['genre-%d' % genre_id
+                            for genre_id in sorted(set(genre_ids))
+                            if genre_id is not None])
@@ -0,0 +1,468 @@
+"""
+This file holds the write path for movies
+
+The single-movie routes in __init__.py go through the ORM one row at a time,
+which is fine for a person filling in a form but far too slow for scripted
+imports of hundreds of titles
+
+Batch writes
+- apply_movie_batch() takes a list of operations, checks each one against the
+  logged in user and applies everything that passes in ONE transaction
+- Rows are grouped and written with bulk statements (executemany) instead of
+  one ORM flush per movie
+- The movies to update or delete are locked while their owners are checked,
+  so what the results, genre_stats and the change feed record is what the
+  bulk statements really changed
+- Every operation gets a result back, in the same order it was sent, so the
+  caller can tell which rows were rejected and why
+
+Single movie writes
+- update_owned_movie() and delete_owned_movie() each run ONE statement whose
+  WHERE clause carries the owner (and for updates the version the form was
+  rendered with), then look at the row count
+- Only when nothing matched do we spend a second query finding out why
+
+Every write also updates genre_stats (see genre_stats.py) and appends to the
+change log (see change_feed.py) in the same transaction, so neither can
+drift from the movie table
+
+Operation format (JSON)
+    {"op": "create", "genre_id": 3, "name": "Alien", "description": "..."}
+    {"op": "update", "id": 17, "name": "Aliens"}
+    {"op": "delete", "id": 17}
+"""
+from sqlalchemy import bindparam, delete, select, update
+
+import change_feed
+import genre_stats
+from database_setup import Genre, Movie
+
+# Upper bound on operations accepted in a single request
+BATCH_LIMIT = 5000
+
+# Keep IN (...) lists below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 500
+
+# Column sizes from database_setup.py
+NAME_LENGTH = 80
+DESCRIPTION_LENGTH = 250
+
+
+class BatchError(ValueError):
+    '''
+        Raised when the batch as a whole can't be processed (not a list,
+        too many operations, ...)
+    '''
+
+
+def _chunks(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _result(index, op, status, movie_id=None, error=None, genre_id=None):
+    result = {'index': index, 'op': op, 'status': status}
+    if movie_id is not None:
+        result['id'] = movie_id
+    if genre_id is not None:
+        result['genre_id'] = genre_id
+    if error is not None:
+        result['error'] = error
+    return result
+
+
+def _is_id(value):
+    # JSON true/false arrive as bool, which is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_text(operation, required):
+    '''
+        Validates the name/description fields of an operation.
+
+        Returns
+            error (str): Description of the problem, None if the fields are ok
+    '''
+    name = operation.get('name')
+    description = operation.get('description')
+
+    if required and not name:
+        return 'name is required'
+    if name is not None and (not isinstance(name, str) or
+                             len(name) > NAME_LENGTH):
+        return 'name must be a string of at most %d characters' % NAME_LENGTH
+    if description is not None and (not isinstance(description, str) or
+                                    len(description) > DESCRIPTION_LENGTH):
+        return ('description must be a string of at most %d characters'
+                % DESCRIPTION_LENGTH)
+    return None
+
+
+def _validate(operations):
+    '''
+        Splits the raw operations into rejected results and pending work.
+
+        Returns
+            results (list): Result slot per operation, None while pending
+            creates, updates, deletes (list): (index, operation) pairs
+    '''
+    if not isinstance(operations, list):
+        raise BatchError('operations must be a list')
+    if len(operations) > BATCH_LIMIT:
+        raise BatchError('at most %d operations per batch' % BATCH_LIMIT)
+
+    results = [None] * len(operations)
+    creates, updates, deletes = [], [], []
+    seen_ids = set()
+
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            results[index] = _result(index, None, 'invalid',
+                                     error='operation must be an object')
+            continue
+
+        op = operation.get('op')
+        if op == 'create':
+            if not _is_id(operation.get('genre_id')):
+                error = 'genre_id must be an integer'
+            else:
+                error = _check_text(operation, required=True)
+            if error:
+                results[index] = _result(index, op, 'invalid', error=error)
+            else:
+                creates.append((index, operation))
+            continue
+
+        if op not in ('update', 'delete'):
+            results[index] = _result(index, op, 'invalid',
+                                     error='op must be create, update or '
+                                           'delete')
+            continue
+
+        movie_id = operation.get('id')
+        if not _is_id(movie_id):
+            results[index] = _result(index, op, 'invalid',
+                                     error='id must be an integer')
+            continue
+        # Grouping rows into bulk statements loses the request order, so a
+        # movie may only be touched once per batch
+        if movie_id in seen_ids:
+            results[index] = _result(index, op, 'invalid', movie_id,
+                                     'movie already modified in this batch')
+            continue
+
+        if op == 'update':
+            error = _check_text(operation, required=False)
+            if not error and operation.get('name') is None \
+                    and operation.get('description') is None:
+                error = 'nothing to update'
+            if error:
+                results[index] = _result(index, op, 'invalid', movie_id,
+                                         error)
+                continue
+            updates.append((index, operation))
+        else:
+            deletes.append((index, operation))
+        seen_ids.add(movie_id)
+
+    return results, creates, updates, deletes
+
+
+def _owners(session, movie_ids):
+    '''
+        Maps movie id -> (owner id, genre id) for the given movies in as few
+        round trips as the IN list limit allows.
+
+        The rows are locked (SELECT ... FOR UPDATE, on the primary) until the
+        transaction ends, so nobody else can change or delete them between
+        this check and the batch's writes. SQLite has no row locks, there
+        the writer already holds the database's write lock (sqlite_mode.py).
+    '''
+    owners = {}
+    # Always lock in id order, so two batches can't deadlock each other
+    for chunk in _chunks(sorted(movie_ids)):
+        rows = session.execute(
+            select(Movie.id, Movie.user_id, Movie.genre_id)
+            .where(Movie.id.in_(chunk))
+            .order_by(Movie.id)
+            .with_for_update())
+        owners.update((movie_id, (user_id, genre_id))
+                      for movie_id, user_id, genre_id in rows)
+    return owners
+
+
+def _existing_genres(session, genre_ids):
+    genres = set()
+    for chunk in _chunks(genre_ids):
+        genres.update(session.execute(
+            select(Genre.id).where(Genre.id.in_(chunk))).scalars())
+    return genres
+
+
+def _insert_movies(session, rows):
+    '''
+        Inserts movies with one executemany.
+
+        Returns
+            ids (list): The new movies' ids, in the order of rows
+    '''
+    table = Movie.__table__
+    if session.get_bind().dialect.insert_executemany_returning:
+        # Postgres: the ids come back from the INSERT itself
+        return list(session.execute(table.insert().returning(table.c.id),
+                                    rows).scalars())
+    session.execute(table.insert(), rows)
+    # SQLite holds the write lock from the first insert until the commit, so
+    # nobody else inserted meanwhile and the new rows got the highest ids,
+    # in insert order
+    ids = session.execute(select(table.c.id).order_by(table.c.id.desc())
+                          .limit(len(rows))).scalars().all()
+    return ids[::-1]
+
+
+def apply_movie_batch(session, user_id, operations):
+    '''
+        Applies a batch of create/update/delete operations for a user.
+
+        Only movies owned by user_id may be updated or deleted. Rejected
+        operations don't stop the rest of the batch; everything accepted is
+        committed together.
+
+        Params
+            session (Session): Database session to write through
+            user_id (int): Id of the logged in user
+            operations (list): Operation dicts, see module docstring
+
+        Returns
+            results (list): One result dict per operation, in request order
+
+        Raises
+            BatchError: If operations isn't a list or is too long
+    '''
+    results, creates, updates, deletes = _validate(operations)
+    table = Movie.__table__
+
+    owners = _owners(session, [op['id'] for _, op in updates + deletes])
+    genres = _existing_genres(session,
+                              set(op['genre_id'] for _, op in creates))
+
+    def allowed(pending):
+        accepted = []
+        for index, operation in pending:
+            movie_id = operation['id']
+            if movie_id not in owners:
+                results[index] = _result(index, operation['op'], 'not_found',
+                                         movie_id)
+            elif owners[movie_id][0] != user_id:
+                results[index] = _result(index, operation['op'], 'forbidden',
+                                         movie_id)
+            else:
+                accepted.append((index, operation))
+        return accepted
+
+    updates = allowed(updates)
+    deletes = allowed(deletes)
+
+    new_rows = []
+    for index, operation in creates:
+        if operation['genre_id'] not in genres:
+            results[index] = _result(index, 'create', 'invalid',
+                                     error='unknown genre_id')
+            continue
+        new_rows.append((index, {'name': operation['name'],
+                                 'description': operation.get('description'),
+                                 'genre_id': operation['genre_id'],
+                                 'user_id': user_id}))
+
+    try:
+        if new_rows:
+            # The new ids are reported back per item
+            ids = _insert_movies(session, [row for _, row in new_rows])
+            for (index, row), movie_id in zip(new_rows, ids):
+                row['id'] = movie_id
+                results[index] = _result(index, 'create', 'created',
+                                         movie_id, genre_id=row['genre_id'])
+
+        # Updates only touch the columns that were sent, so group rows by
+        # the set of columns and run one executemany per group
+        groups = {}
+        for index, operation in updates:
+            columns = tuple(column for column in ('name', 'description')
+                            if operation.get(column) is not None)
+            params = {'b_id': operation['id'], 'b_user_id': user_id}
+            for column in columns:
+                params['b_' + column] = operation[column]
+            groups.setdefault(columns, []).append((index, params))
+
+        for columns, rows in groups.items():
+            values = {column: bindparam('b_' + column) for column in columns}
+            values['version'] = table.c.version + 1
+            statement = (
+                update(table)
+                .where(table.c.id == bindparam('b_id'))
+                .where(table.c.user_id == bindparam('b_user_id'))
+                .values(values)
+            )
+            session.execute(statement, [params for _, params in rows])
+            for index, params in rows:
+                results[index] = _result(index, 'update', 'updated',
+                                         params['b_id'],
+                                         genre_id=owners[params['b_id']][1])
+
+        for chunk in _chunks(deletes):
+            session.execute(
+                delete(table)
+                .where(table.c.id.in_([op['id'] for _, op in chunk]))
+                .where(table.c.user_id == user_id))
+            for index, operation in chunk:
+                results[index] = _result(index, 'delete', 'deleted',
+                                         operation['id'],
+                                         genre_id=owners[operation['id']][1])
+
+        deltas = {}
+        for _, row in new_rows:
+            deltas[row['genre_id']] = deltas.get(row['genre_id'], 0) + 1
+        for _, operation in updates:
+            deltas.setdefault(owners[operation['id']][1], 0)
+        for _, operation in deletes:
+            genre_id = owners[operation['id']][1]
+            deltas[genre_id] = deltas.get(genre_id, 0) - 1
+        genre_stats.bump(session, deltas)
+
+        changes = [(row['id'], row['genre_id'], 'upsert')
+                   for _, row in new_rows]
+        changes += [(operation['id'], owners[operation['id']][1], 'upsert')
+                    for _, operation in updates]
+        changes += [(operation['id'], owners[operation['id']][1], 'delete')
+                    for _, operation in deletes]
+        change_feed.record(session, changes)
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return results
+
+
+def create_movie(session, genre_id, user_id, name, description=None):
+    '''
+        Inserts a movie and counts it in its genre's stats, in one
+        transaction.
+
+        Params
+            session (Session): Database session to write through
+            genre_id (int): Genre of the new movie
+            user_id (int): Id of the logged in user, becomes the owner
+            name (str): Name of the movie
+            description (str): Description, may be None
+
+        Returns
+            movie_id (int): Id of the new movie
+    '''
+    movie = Movie(name=name, description=description, genre_id=genre_id,
+                  user_id=user_id)
+    try:
+        session.add(movie)
+        session.flush()
+        genre_stats.bump(session, {genre_id: 1})
+        change_feed.record(session, [(movie.id, genre_id, 'upsert')])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return movie.id
+
+
+def _why_unchanged(session, movie_id, user_id):
+    '''
+        Works out why an ownership-checked statement matched no rows.
+
+        Returns
+            status (str): 'not_found', 'forbidden' or 'conflict'
+    '''
+    owner = session.execute(
+        select(Movie.user_id).where(Movie.id == movie_id)).scalar()
+    if owner is None:
+        return 'not_found'
+    if owner != user_id:
+        return 'forbidden'
+    return 'conflict'
+
+
+def update_owned_movie(session, movie_id, user_id, version, name=None,
+                       description=None):
+    '''
+        Updates a movie in a single UPDATE ... WHERE id AND user_id AND
+        version statement.
+
+        Params
+            session (Session): Database session to write through
+            movie_id (int): Id of the movie to edit
+            user_id (int): Id of the logged in user, must own the movie
+            version (int): Version of the movie the edit is based on
+            name (str): New name, None to keep the current one
+            description (str): New description, None to keep the current one
+
+        Returns
+            status (str): 'updated', 'not_found', 'forbidden' or 'conflict'
+                (someone else saved the movie since version was read)
+    '''
+    table = Movie.__table__
+    values = {'version': table.c.version + 1}
+    if name is not None:
+        values['name'] = name
+    if description is not None:
+        values['description'] = description
+
+    try:
+        result = session.execute(
+            update(table)
+            .where(table.c.id == movie_id)
+            .where(table.c.user_id == user_id)
+            .where(table.c.version == version)
+            .values(values))
+        if result.rowcount == 1:
+            genre_stats.touch_movie_genre(session, movie_id)
+            change_feed.record_movie(session, movie_id, 'upsert')
+            session.commit()
+            return 'updated'
+        status = _why_unchanged(session, movie_id, user_id)
+        session.rollback()
+        return status
+    except Exception:
+        session.rollback()
+        raise
+
+
+def delete_owned_movie(session, movie_id, user_id):
+    '''
+        Deletes a movie in a single DELETE ... WHERE id AND user_id statement.
+
+        Params
+            session (Session): Database session to write through
+            movie_id (int): Id of the movie to delete
+            user_id (int): Id of the logged in user, must own the movie
+
+        Returns
+            status (str): 'deleted', 'not_found' or 'forbidden'
+    '''
+    table = Movie.__table__
+    try:
+        # Rolled back below if the movie turns out not to be deletable
+        genre_stats.touch_movie_genre(session, movie_id, -1)
+        change_feed.record_movie(session, movie_id, 'delete')
+        result = session.execute(
+            delete(table)
+            .where(table.c.id == movie_id)
+            .where(table.c.user_id == user_id))
+        if result.rowcount == 1:
+            session.commit()
+            return 'deleted'
+        status = _why_unchanged(session, movie_id, user_id)
+        session.rollback()
+        return status
+    except Exception:
+        session.rollback()
+        raise
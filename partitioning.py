@@ -0,0 +1,135 @@
+"""
+This file splits the Postgres movie table into hash partitions by genre
+
+With hundreds of millions of movies one movie table means one huge heap and
+huge indexes: every vacuum and index rebuild goes over all of it, and a
+genre page searches an index that covers every genre. Declarative
+partitioning (Postgres 11+) makes movie a parent of PARTITIONS tables
+movie_p0, movie_p1, ..., each holding the genres whose hash falls into it
+- A genre's movies all live in one partition, so the genre page queries
+  (read_models.MOVIES_BY_GENRE, WHERE genre_id = ...) only search that
+  partition's genre_id index
+- Autovacuum, ANALYZE and REINDEX work partition by partition, so
+  maintenance is bounded by the size of a partition, not of the table
+- The primary key becomes (id, genre_id), Postgres requires the partition
+  key in it. Ids still come from the same sequence, and lookups by id alone
+  (solo_json, edits) search the primary key index of every partition
+- Nothing else changes for the app: SQLAlchemy still maps the movie table
+- Hash partitions spread genres evenly, but one genre can't span several:
+  a genre that is a large share of all movies makes its partition large
+  too. Archiving cold movies (movie_archive.py) keeps the partitions small
+
+Converting copies the movies into the new partitioned table and swaps the
+two by renaming, in ONE transaction. Movie writes wait until it's done
+(reads go on), so run it in a quiet hour, or right after creating an empty
+database. The old table is kept as movie_unpartitioned unless --drop-old is
+given; drop it once the app runs fine
+
+Usage, on the database CATALOG_DATABASE_URL points at
+    python partitioning.py [--partitions 16] [--drop-old]
+The number of partitions is fixed after that: changing it means converting
+again from an unpartitioned table
+"""
+import argparse
+import time
+
+from sqlalchemy import text
+
+PARTITIONS = 16
+
+
+def is_partitioned(connection, name='movie'):
+    return bool(connection.execute(
+        text("SELECT relkind = 'p' FROM pg_class "
+             "WHERE oid = to_regclass(:name)"), {'name': name}).scalar())
+
+
+def statements(partitions, sequence, drop_old):
+    '''
+        Returns
+            statements (list): The SQL converting movie, in order
+    '''
+    sql = [
+        # Same columns and defaults (the id sequence among them)
+        'CREATE TABLE movie_partitioned (LIKE movie INCLUDING DEFAULTS) '
+        'PARTITION BY HASH (genre_id)',
+        'ALTER TABLE movie_partitioned ALTER COLUMN genre_id SET NOT NULL',
+    ]
+    for remainder in range(partitions):
+        sql.append('CREATE TABLE movie_p%d PARTITION OF movie_partitioned '
+                   'FOR VALUES WITH (MODULUS %d, REMAINDER %d)'
+                   % (remainder, partitions, remainder))
+    sql += [
+        'INSERT INTO movie_partitioned SELECT * FROM movie',
+        # Indexes and keys after the copy: building them once is faster
+        # than updating them row by row
+        'ALTER TABLE movie_partitioned ADD PRIMARY KEY (id, genre_id)',
+        'CREATE INDEX ON movie_partitioned (genre_id)',
+        'ALTER TABLE movie_partitioned ADD FOREIGN KEY (genre_id) '
+        'REFERENCES genre (id)',
+        'ALTER TABLE movie_partitioned ADD FOREIGN KEY (user_id) '
+        'REFERENCES "user" (id)',
+        # Or dropping the old table would drop the sequence with it
+        'ALTER SEQUENCE %s OWNED BY movie_partitioned.id' % sequence,
+        'ALTER TABLE movie RENAME TO movie_unpartitioned',
+        'ALTER TABLE movie_partitioned RENAME TO movie',
+        'ANALYZE movie',
+    ]
+    if drop_old:
+        sql.append('DROP TABLE movie_unpartitioned')
+    return sql
+
+
+def partition(engine, partitions=PARTITIONS, drop_old=False):
+    '''
+        Converts the movie table into a table partitioned by genre_id hash,
+        in one transaction.
+
+        Returns
+            movies (int): Movies copied
+    '''
+    if engine.dialect.name != 'postgresql':
+        raise ValueError("Partitioning needs Postgres, not %s"
+                         % engine.dialect.name)
+    with engine.begin() as connection:
+        if is_partitioned(connection):
+            raise ValueError("movie is already partitioned")
+        if connection.execute(text(
+                "SELECT 1 FROM pg_class WHERE oid = "
+                "to_regclass('movie_unpartitioned')")).first():
+            raise ValueError("movie_unpartitioned exists, drop it first")
+        # Foreign keys can't point at (id) of a table whose key is
+        # (id, genre_id)
+        referencing = connection.execute(text(
+            "SELECT conname FROM pg_constraint "
+            "WHERE confrelid = 'movie'::regclass")).scalars().all()
+        if referencing:
+            raise ValueError("Foreign keys reference movie: %s"
+                             % ', '.join(referencing))
+        # Writes wait from here on, reads go on
+        connection.execute(text('LOCK TABLE movie IN SHARE MODE'))
+        if connection.execute(text(
+                'SELECT 1 FROM movie WHERE genre_id IS NULL LIMIT 1')).first():
+            raise ValueError("Movies without a genre can't be partitioned "
+                             "by genre, give them one first")
+        sequence = connection.execute(text(
+            "SELECT pg_get_serial_sequence('movie', 'id')")).scalar()
+        for statement in statements(partitions, sequence, drop_old):
+            connection.execute(text(statement))
+        return connection.execute(text('SELECT count(*) FROM movie')).scalar()
+
+
+if __name__ == '__main__':
+    from database_setup import engine
+
+    parser = argparse.ArgumentParser(
+        description='Partition the Postgres movie table by genre')
+    parser.add_argument('--partitions', type=int, default=PARTITIONS)
+    parser.add_argument('--drop-old', action='store_true',
+                        help="don't keep the table as movie_unpartitioned")
+    args = parser.parse_args()
+
+    start = time.time()
+    movies = partition(engine, args.partitions, args.drop_old)
+    print("Partitioned %d movies into %d partitions in %.1f s"
+          % (movies, args.partitions, time.time() - start))
@@ -0,0 +1,171 @@
+"""
+This file profiles single requests on demand, in production
+
+When a route is slow it's hard to tell whether the time goes to SQLAlchemy,
+Jinja, serializing or a call to Google/Facebook. A profiled request is
+sampled by a background thread every INTERVAL ms: it records the request
+thread's current call stack, so the request itself runs at normal speed
+(no per-call tracing like cProfile)
+
+A request is profiled when
+- it carries the header 'X-Catalog-Profile: <CATALOG_PROFILE_TOKEN>', the
+  response then names the profile in an 'X-Catalog-Profile' header, or
+- it is picked at random, with probability CATALOG_PROFILE_RATE
+
+Each profile is written to CATALOG_PROFILE_DIR as two files
+    <time>-<endpoint>-<ms>ms.folded   one 'frame;frame;... count' per stack,
+                                      the root frame is 'GET /route/rule'
+    <time>-<endpoint>-<ms>ms.json     route, status, wall/CPU time, samples
+The .folded files are what flamegraph.pl and speedscope read, several can
+be concatenated to see a route over many requests
+
+With neither the token nor a rate set nothing is registered with the app at
+all, so profiling costs nothing while it's off
+"""
+import collections
+import datetime
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+
+TOKEN = os.environ.get('CATALOG_PROFILE_TOKEN')
+RATE = float(os.environ.get('CATALOG_PROFILE_RATE', '0'))
+DIRECTORY = os.environ.get('CATALOG_PROFILE_DIR',
+                           '/var/www/catalog/profiles')
+INTERVAL = float(os.environ.get('CATALOG_PROFILE_INTERVAL', '5')) / 1000
+
+HEADER = 'X-Catalog-Profile'
+
+log = logging.getLogger(__name__)
+
+
+def frame_name(code, line):
+    filename = code.co_filename
+    # Shorten site-packages/... and the app's own directory
+    for marker in ('site-packages' + os.sep, 'lib' + os.sep + 'python'):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    else:
+        filename = os.path.basename(filename)
+    return '%s (%s:%d)' % (code.co_name, filename, line)
+
+
+class Sampler(threading.Thread):
+    '''
+        Samples the call stack of one thread until stop() is called.
+
+        Attributes
+            stacks (Counter): Folded stack ('outer;...;inner') -> samples
+    '''
+    def __init__(self, thread_id, interval=INTERVAL):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.stacks
+
+
+def wanted():
+    if TOKEN and hmac.compare_digest(request.headers.get(HEADER, ''), TOKEN):
+        return 'header'
+    if RATE and random.random() < RATE:
+        return 'sampled'
+    return None
+
+
+def start_profile():
+    trigger = wanted()
+    if trigger is None:
+        return
+    sampler = Sampler(threading.get_ident())
+    g.profile = {
+        'trigger': trigger,
+        'sampler': sampler,
+        'started': time.perf_counter(),
+        'cpu': time.thread_time(),
+        'name': '%s-%s' % (
+            datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'),
+            request.endpoint or 'none'),
+    }
+    sampler.start()
+
+
+def name_profile(response):
+    profile = g.get('profile')
+    if profile is not None:
+        profile['status'] = response.status_code
+        if profile['trigger'] == 'header':
+            # The file name isn't final yet (it gets the duration), send
+            # the prefix to look for
+            response.headers[HEADER] = profile['name']
+    return response
+
+
+def finish_profile(exception=None):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    wall = time.perf_counter() - profile['started']
+    cpu = time.thread_time() - profile['cpu']
+    stacks = profile['sampler'].stop()
+
+    rule = request.url_rule.rule if request.url_rule else request.path
+    root = '%s %s' % (request.method, rule)
+    name = '%s-%dms' % (profile['name'], wall * 1000)
+    try:
+        os.makedirs(DIRECTORY, exist_ok=True)
+        with open(os.path.join(DIRECTORY, name + '.folded'), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s;%s %d\n' % (root, stack, count))
+        with open(os.path.join(DIRECTORY, name + '.json'), 'w') as f:
+            json.dump({
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'rule': rule,
+                'path': request.full_path.rstrip('?'),
+                'status': profile.get('status'),
+                'error': repr(exception) if exception else None,
+                'trigger': profile['trigger'],
+                'wall_ms': round(wall * 1000, 2),
+                'cpu_ms': round(cpu * 1000, 2),
+                'samples': sum(stacks.values()),
+                'interval_ms': INTERVAL * 1000,
+            }, f, indent=2)
+    except (IOError, OSError):
+        log.exception("Writing profile %s failed", name)
+
+
+def init_app(app):
+    '''
+        Registers the profiling hooks, only if profiling is configured.
+        Call it before the app's own hooks so they are profiled too.
+    '''
+    if not TOKEN and not RATE:
+        return
+    app.before_request(start_profile)
+    app.after_request(name_profile)
+    app.teardown_request(finish_profile)
@@ -0,0 +1,149 @@
+"""
+This file lets a caching reverse proxy (Varnish, Fastly, ...) cache the
+public pages and purge them when movies change
+
+Public responses
+- GET requests from visitors who aren't logged in are cacheable. Views name
+  what a response shows with surrogate_keys('genre-3', 'movie-17', ...)
+- Those responses get 'Cache-Control: public, max-age=0, s-maxage=N' (only
+  the proxy caches them, browsers still revalidate) and a 'Surrogate-Key'
+  header, and the session cookie is kept out of Vary
+- The per-visitor parts (login button, flashed messages) are left out of the
+  cacheable body (`cacheable` is set). The page's script picks the button
+  from the 'logged_in' cookie, and only a visitor carrying it or the
+  'flashed' cookie (messages are waiting) loads /session.html, a tiny
+  uncacheable fragment. Everyone else's page view never reaches the app
+- Everything else is sent 'Cache-Control: private'
+
+Logged in users must never be answered from the cache, so while someone is
+logged in they carry a 'logged_in' cookie the proxy can bypass the cache on.
+Both cookies are readable by scripts and carry nothing but their presence
+
+Purging
+- send_purge(keys) sends one request to CATALOG_PURGE_URL with the keys in a
+  Surrogate-Key header (method CATALOG_PURGE_METHOD, PURGE by default). The
+  app runs it as a background job (tasks.py) so it's retried if it fails
+- purge(keys) does the same right away, logging failures
+- Without CATALOG_PURGE_URL purging is switched off
+
+tools/stub_proxy.py is a small caching proxy speaking this protocol, for
+trying it all out locally
+"""
+import logging
+import os
+
+import requests
+from flask import g, render_template, request, session as login_session
+from flask.sessions import SecureCookieSessionInterface
+
+PURGE_URL = os.environ.get('CATALOG_PURGE_URL')
+PURGE_METHOD = os.environ.get('CATALOG_PURGE_METHOD', 'PURGE')
+# How long the proxy may serve a page without asking the app again
+S_MAXAGE = int(os.environ.get('CATALOG_PROXY_MAX_AGE', '300'))
+
+LOGGED_IN_COOKIE = 'logged_in'
+# Set while the session holds flashed messages not shown yet
+FLASHED_COOKIE = 'flashed'
+
+log = logging.getLogger(__name__)
+
+
+def surrogate_keys(*keys):
+    '''
+        Tags the current response with surrogate keys, making it cacheable
+        by the proxy if the visitor isn't logged in.
+    '''
+    g.surrogate_keys = getattr(g, 'surrogate_keys', ()) + keys
+
+
+def is_cacheable():
+    return (request.method in ('GET', 'HEAD') and
+            'username' not in login_session)
+
+
+def send_purge(keys):
+    '''
+        Asks the proxy to drop every cached response tagged with any of keys.
+        Raises requests.RequestException if that failed.
+    '''
+    keys = sorted(set(keys))
+    if not PURGE_URL or not keys:
+        return
+    requests.request(PURGE_METHOD, PURGE_URL,
+                     headers={'Surrogate-Key': ' '.join(keys)},
+                     timeout=2).raise_for_status()
+
+
+def purge(keys):
+    '''
+        Like send_purge() but only logs failures, the cached copies then
+        expire after S_MAXAGE.
+    '''
+    try:
+        send_purge(keys)
+    except requests.RequestException:
+        log.exception("Purging %s failed", ' '.join(sorted(set(keys))))
+
+
+class CacheFriendlySessionInterface(SecureCookieSessionInterface):
+    '''
+        Flask adds 'Vary: Cookie' to every response that looked at the
+        session, which makes a shared cache keep one copy per visitor.
+        Public responses don't depend on the session, so drop it there.
+    '''
+    def save_session(self, app, session, response):
+        super().save_session(app, session, response)
+        if getattr(response, 'public', False):
+            response.vary.discard('Cookie')
+
+
+def cache_headers(response):
+    # Already public (hashed assets, avatars): leave the session alone so
+    # Flask doesn't add 'Vary: Cookie'
+    if 'public' in response.headers.get('Cache-Control', ''):
+        response.public = True
+        return response
+
+    logged_in = 'username' in login_session
+    public = (getattr(g, 'surrogate_keys', None) and is_cacheable() and
+              response.status_code == 200 and
+              'Set-Cookie' not in response.headers)
+
+    if public:
+        response.public = True
+        response.headers['Cache-Control'] = ('public, max-age=0, s-maxage=%d'
+                                             % S_MAXAGE)
+        response.headers['Surrogate-Key'] = ' '.join(g.surrogate_keys)
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'private'
+
+    # Keep the proxy's bypass cookie and the pages' flash marker in step
+    # with the session
+    flashed = bool(login_session.get('_flashes'))
+    changed = False
+    for name, wanted in ((LOGGED_IN_COOKIE, logged_in),
+                         (FLASHED_COOKIE, flashed)):
+        if wanted and name not in request.cookies:
+            response.set_cookie(name, '1', samesite='Lax')
+            changed = True
+        elif not wanted and name in request.cookies:
+            response.delete_cookie(name)
+            changed = True
+    if changed and public:
+        # A shared cache must not hand the Set-Cookie to others
+        response.public = False
+        response.headers['Cache-Control'] = 'private'
+        del response.headers['Surrogate-Key']
+    return response
+
+
+def session_fragment():
+    response = render_template('session.html')
+    return response, 200, {'Cache-Control': 'private, no-store'}
+
+
+def init_app(app):
+    app.session_interface = CacheFriendlySessionInterface()
+    app.after_request(cache_headers)
+    app.context_processor(lambda: {'cacheable': is_cacheable()})
+    app.add_url_rule('/session.html', 'session_fragment', session_fragment)
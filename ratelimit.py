@@ -0,0 +1,285 @@
+"""
+This file rate limits the login and API routes with token buckets
+
+One client looping over the JSON endpoints, or a bot posting to /gconnect and
+/fbconnect (each of which calls Google/Facebook), can keep every worker
+thread and database connection busy. Requests to the limited routes take a
+token from two buckets first
+- the client's bucket for the route group (per IP address)
+- the group's total bucket, shared by all clients (load shedding)
+A bucket holds up to N tokens and gets N back every S seconds ('N/S'). When
+a bucket is empty the request is answered 429 with a Retry-After header
+right away, before the view does any database or outbound work (the ASGI
+mode, asgi.py, applies the same limits)
+
+The buckets are shared by every process of the app (mod_wsgi daemons,
+gunicorn workers), kept in
+- a SQLite file (the default, for a single server), or
+- Redis (CATALOG_RATE_LIMIT_STORE=redis://..., needs pip install redis)
+If the store fails the request is let through and the error logged.
+Requests the app makes to itself (snapshot.py's export) carry INTERNAL in
+their WSGI environ and aren't limited: clients can only set headers
+
+Settings (environment variables)
+    CATALOG_RATE_LIMIT_STORE       SQLite file or redis:// URL, 'off' to
+                                   switch limiting off
+                                   (/var/www/catalog/ratelimit.sqlite)
+    CATALOG_RATE_LIMIT_<GROUP>     per client limit of a group of GROUPS,
+                                   e.g. CATALOG_RATE_LIMIT_API=120/60, 0 for
+                                   none
+    CATALOG_RATE_LIMIT_<GROUP>_TOTAL   limit for all clients together
+    CATALOG_RATE_LIMIT_PROXIES     reverse proxies in front of the app whose
+                                   X-Forwarded-For is trusted (0)
+"""
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from flask import make_response, request
+
+try:
+    import redis
+except ImportError:  # Only needed with a redis:// store
+    redis = None
+
+STORE = os.environ.get('CATALOG_RATE_LIMIT_STORE',
+                       '/var/www/catalog/ratelimit.sqlite')
+PROXIES = int(os.environ.get('CATALOG_RATE_LIMIT_PROXIES', '0'))
+
+# Route groups: endpoints, default per client limit, default total limit
+GROUPS = {
+    'login': (('gconnect', 'fbconnect'), '10/60', '300/60'),
+    'api': (('catalog_json', 'movies_json', 'solo_json', 'similar_json',
+             'changes_json', 'bulk_movies_json'), '120/60', '6000/60'),
+}
+
+# WSGI environ key of the app's own requests
+INTERNAL = 'catalog.internal'
+
+log = logging.getLogger(__name__)
+
+
+def parse_limit(value):
+    '''
+        Returns
+            limit (tuple): (capacity, tokens per second) for 'N/S', None
+                for '0'
+    '''
+    if value.strip() == '0':
+        return None
+    count, seconds = value.split('/')
+    return float(count), float(count) / float(seconds)
+
+
+def load_rules():
+    '''
+        Returns
+            rules (dict): endpoint -> (group, per client limit, total limit)
+    '''
+    rules = {}
+    for group, (endpoints, client, total) in GROUPS.items():
+        name = 'CATALOG_RATE_LIMIT_%s' % group.upper()
+        client = parse_limit(os.environ.get(name, client))
+        total = parse_limit(os.environ.get(name + '_TOTAL', total))
+        for endpoint in endpoints:
+            rules[endpoint] = (group, client, total)
+    return rules
+
+
+RULES = load_rules()
+
+
+def refill(tokens, updated, capacity, rate, now):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class SQLiteStore(object):
+    '''
+        Buckets in a SQLite file, one connection per thread. A take() is a
+        single write transaction, so processes take tokens one at a time.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        # A connection must not cross a fork, open one per process too
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1,
+                                         isolation_level=None)
+            # Losing the buckets in a crash doesn't matter, skip the fsyncs
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, '
+                'tokens REAL, updated REAL, full_at REAL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def take(self, buckets, now):
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            for key, (capacity, rate) in buckets:
+                row = connection.execute(
+                    'SELECT tokens, updated FROM bucket WHERE key = ?',
+                    (key,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                levels.append(refill(tokens, updated, capacity, rate, now))
+            # Let the request through only if every bucket has a token
+            wait = 0
+            for level, (key, (capacity, rate)) in zip(levels, buckets):
+                if level < 1:
+                    wait = max(wait, (1 - level) / rate)
+            for level, (key, (capacity, rate)) in zip(levels, buckets):
+                if not wait:
+                    level -= 1
+                connection.execute(
+                    'INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?)',
+                    (key, level, now, now + (capacity - level) / rate))
+            # Now and then forget the buckets that are full again
+            if random.random() < 0.001:
+                connection.execute('DELETE FROM bucket WHERE full_at < ?',
+                                   (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+# Same as SQLiteStore.take, atomic on the Redis server. Returns the wait as
+# a string, Redis would round a number
+TAKE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    levels[i] = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if levels[i] < 1 then
+        wait = math.max(wait, (1 - levels[i]) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i])
+    local rate = tonumber(ARGV[2 * i + 1])
+    local level = levels[i]
+    if wait == 0 then
+        level = level - 1
+    end
+    redis.call('HSET', key, 'tokens', level, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil((capacity - level) / rate) + 1)
+end
+return tostring(wait)
+'''
+
+
+class RedisStore(object):
+    '''
+        Buckets in Redis hashes, updated by one Lua script per take(). They
+        expire once they are full again.
+    '''
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("%s needs the redis package "
+                               "(pip install redis)" % url)
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, buckets, now):
+        args = [now]
+        for key, limit in buckets:
+            args.extend(limit)
+        keys = ['catalog:ratelimit:%s' % key for key, limit in buckets]
+        return float(self.script(keys=keys, args=args))
+
+
+def open_store(url):
+    if url == 'off':
+        return None
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    return SQLiteStore(url)
+
+
+store = open_store(STORE)
+
+
+def client_address(remote_addr, forwarded_for):
+    '''
+        Returns
+            address (str): The client's IP address, taken from
+                X-Forwarded-For when the app is behind PROXIES proxies
+    '''
+    if PROXIES and forwarded_for:
+        forwarded = forwarded_for.split(',')
+        if len(forwarded) >= PROXIES:
+            return forwarded[-PROXIES].strip()
+    return remote_addr or 'unknown'
+
+
+def wait_time(endpoint, address, now=None):
+    '''
+        Takes a token from the client's and the total bucket of the group
+        endpoint belongs to.
+
+        Returns
+            wait (float): 0 if the request may go on, otherwise the seconds
+                until it would be let through
+    '''
+    if store is None or endpoint not in RULES:
+        return 0
+    group, client, total = RULES[endpoint]
+    buckets = []
+    if client:
+        buckets.append(('%s:%s' % (group, address), client))
+    if total:
+        buckets.append(('%s:*' % group, total))
+    if not buckets:
+        return 0
+    try:
+        return store.take(buckets, time.time() if now is None else now)
+    except Exception:
+        log.exception("Rate limit store failed, letting %s through",
+                      endpoint)
+        return 0
+
+
+def retry_after(wait):
+    return max(1, int(math.ceil(wait)))
+
+
+def limit_request():
+    if request.environ.get(INTERNAL):
+        return None
+    wait = wait_time(request.endpoint, client_address(
+        request.remote_addr, request.headers.get('X-Forwarded-For')))
+    if not wait:
+        return None
+    seconds = retry_after(wait)
+    response = make_response(json.dumps(
+        'Too many requests, retry in %d seconds' % seconds), 429)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+def init_app(app):
+    '''
+        Limits the routes in GROUPS. Call it before any hook that touches
+        the database.
+    '''
+    if store is not None and RULES:
+        app.before_request(limit_request)
@@ -0,0 +1,198 @@
+"""
+This file is a lightweight read layer for the read-only routes
+
+Loading Genre/Movie/User through the ORM builds a full mapped instance per
+row (instance state, attribute instrumentation, identity map entry, lazy
+relationship loaders) just so a template can print a name. The read routes
+never change what they load, so here the rows are fetched as plain column
+tuples and wrapped in small immutable objects instead
+
+Read models
+- GenreView, MovieView and UserView are namedtuples with __slots__ = (), so
+  an instance is a bare tuple: no __dict__, no ORM state
+- They have the attributes the templates use (genre.name, movie.id, ...)
+  and the same serialize output as the models in database_setup.py
+- MovieView carries its genre's name (joined in the query), so serialize
+  doesn't need a second query per movie like Movie.serialize does
+
+Every loader comes as a pre-declared statement (GENRE_BY_ID, ...) plus a sync
+helper that runs it on a Session. asgi.py runs the same statements on its
+AsyncSession.
+Like Query.one(), the single row helpers raise NoResultFound when the row is
+missing. get_movie also finds archived movies (see movie_archive.py)
+
+Compare with the ORM path
+    python benchmarks/bench_read_models.py     (memory, big genre)
+    python benchmarks/bench_statements.py      (per query overhead)
+"""
+from collections import namedtuple
+
+from sqlalchemy import bindparam, select
+
+from database_setup import Genre, Movie, MovieArchive, MovieSimilar, User
+import movie_archive
+
+
+class GenreView(namedtuple('GenreView', 'id name')):
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        '''
+            Return object data in easily serializeable format
+        '''
+        return {
+            'name': self.name,
+            'id': self.id
+        }
+
+
+class MovieView(namedtuple('MovieView',
+                           'id name description genre_id user_id genre_name')):
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        '''
+            Return object data in easily serializeable format
+        '''
+        return {
+            'name': self.name,
+            'description': self.description,
+            'id': self.id,
+            'genre': self.genre_name
+        }
+
+
+class UserView(namedtuple('UserView', 'id name email picture')):
+    __slots__ = ()
+
+
+class SimilarView(namedtuple('SimilarView', 'id name genre_id score')):
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        return {
+            'name': self.name,
+            'id': self.id,
+            'genre_id': self.genre_id,
+            'score': round(self.score, 3)
+        }
+
+
+# Column lists, in the order of the namedtuple fields
+GENRE_COLUMNS = (Genre.id, Genre.name)
+MOVIE_COLUMNS = (Movie.id, Movie.name, Movie.description, Movie.genre_id,
+                 Movie.user_id, Genre.name)
+USER_COLUMNS = (User.id, User.name, User.email, User.picture)
+
+
+# Statements
+# Built once at import with bind parameters for the ids, so a request only
+# supplies the values: SQLAlchemy doesn't rebuild the statement, its cache
+# key is computed once and the compiled SQL comes straight from the engine's
+# compiled cache. The drivers see the exact same SQL string every time too,
+# which is what lets them reuse prepared statements (sqlite3's statement
+# cache, asyncpg's prepared statements, see asgi.py)
+GENRES = select(*GENRE_COLUMNS)
+
+GENRE_BY_ID = select(*GENRE_COLUMNS).where(Genre.id == bindparam('genre_id'))
+
+MOVIES_BY_GENRE = (select(*MOVIE_COLUMNS)
+                   .join(Genre, Movie.genre_id == Genre.id)
+                   .where(Movie.genre_id == bindparam('genre_id')))
+
+# Outer join: a movie whose genre is gone still has a page and JSON
+MOVIE_BY_ID = (select(*MOVIE_COLUMNS)
+               .outerjoin(Genre, Movie.genre_id == Genre.id)
+               .where(Movie.id == bindparam('movie_id')))
+
+# Only run when MOVIE_BY_ID found nothing, in the order archived_movie()
+# reads it
+ARCHIVED_MOVIE_BY_ID = (select(MovieArchive.id, MovieArchive.data,
+                               MovieArchive.genre_id, MovieArchive.user_id,
+                               Genre.name)
+                        .outerjoin(Genre, MovieArchive.genre_id == Genre.id)
+                        .where(MovieArchive.id == bindparam('movie_id')))
+
+USER_BY_ID = select(*USER_COLUMNS).where(User.id == bindparam('user_id'))
+
+USER_ID_BY_EMAIL = select(User.id).where(User.email == bindparam('email'))
+
+# Precomputed by similar_movies.py, one primary key range scan
+SIMILAR_TO = (select(Movie.id, Movie.name, Movie.genre_id,
+                     MovieSimilar.score)
+              .join(Movie, Movie.id == MovieSimilar.similar_id)
+              .where(MovieSimilar.movie_id == bindparam('movie_id'))
+              .order_by(MovieSimilar.rank))
+
+
+# Sync helpers
+def get_genres(session):
+    '''
+        Returns
+            genres (list): Every genre as a GenreView
+    '''
+    return [GenreView._make(row) for row in session.execute(GENRES)]
+
+
+def get_genre(session, genre_id):
+    return GenreView._make(
+        session.execute(GENRE_BY_ID, {'genre_id': genre_id}).one())
+
+
+def get_movies(session, genre_id):
+    '''
+        Params
+            session (Session): Database session to read through
+            genre_id (int): Genre whose movies to load
+
+        Returns
+            movies (list): The genre's movies as MovieViews
+    '''
+    return [MovieView._make(row) for row in
+            session.execute(MOVIES_BY_GENRE, {'genre_id': genre_id})]
+
+
+def archived_movie(row):
+    '''
+        Returns
+            movie (MovieView): The movie of an ARCHIVED_MOVIE_BY_ID row
+    '''
+    movie_id, data, genre_id, user_id, genre_name = row
+    name, description = movie_archive.unpack(data)
+    return MovieView(movie_id, name, description, genre_id, user_id,
+                     genre_name)
+
+
+def get_movie(session, movie_id):
+    row = session.execute(MOVIE_BY_ID, {'movie_id': movie_id}).first()
+    if row is not None:
+        return MovieView._make(row)
+    # Not in the movie table, maybe archived
+    return archived_movie(
+        session.execute(ARCHIVED_MOVIE_BY_ID, {'movie_id': movie_id}).one())
+
+
+def get_user(session, user_id):
+    return UserView._make(
+        session.execute(USER_BY_ID, {'user_id': user_id}).one())
+
+
+def get_similar(session, movie_id):
+    '''
+        Returns
+            similar (list): SimilarViews of the movie's similar titles, most
+                similar first (empty until similar_movies.py has run)
+    '''
+    return [SimilarView._make(row) for row in
+            session.execute(SIMILAR_TO, {'movie_id': movie_id})]
+
+
+def get_user_id(session, email):
+    '''
+        Returns
+            user_id (int): Id of the user with that email, None if none
+    '''
+    return session.execute(USER_ID_BY_EMAIL, {'email': email}).scalar()
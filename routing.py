@@ -0,0 +1,63 @@
+"""
+This file routes database traffic between a primary and read replicas
+
+Reads dominate our traffic, so they can be spread over one or more replicas
+while every write goes to the primary
+
+RoutingSession
+- A SQLAlchemy Session that picks an engine per statement in get_bind()
+- Writes (ORM flushes and INSERT/UPDATE/DELETE statements) go to the primary
+- Locking reads (SELECT ... FOR UPDATE) count as writes: the rows they lock
+  are about to be written on the primary
+- Once a transaction has written, the rest of it stays on the primary so it
+  reads its own changes
+- Setting session.info['use_primary'] sends ALL statements to the primary,
+  __init__.py does this for users who wrote recently (read-your-writes)
+- session.info['wrote_at'] records when the last write was committed so the
+  caller can pin the user to the primary for a while
+
+With no replicas configured everything simply goes to the primary
+"""
+import random
+import time
+
+from sqlalchemy.orm import Session
+
+
+class RoutingSession(Session):
+    def __init__(self, primary=None, replicas=(), **kwargs):
+        kwargs.setdefault('bind', primary)
+        super().__init__(**kwargs)
+        self.primary = primary
+        self.replicas = list(replicas)
+        # True once the current transaction has sent a write to the primary
+        self._wrote = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        '''
+            Returns the engine a statement should run on.
+        '''
+        if (getattr(clause, 'is_dml', False) or self._flushing or
+                getattr(clause, '_for_update_arg', None) is not None):
+            self._wrote = True
+
+        if (self._wrote or not self.replicas or
+                self.info.get('use_primary')):
+            return self.primary
+
+        return random.choice(self.replicas)
+
+    def commit(self):
+        try:
+            # commit() flushes first, which may be the first write
+            super().commit()
+            if self._wrote:
+                self.info['wrote_at'] = time.time()
+        finally:
+            self._wrote = False
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._wrote = False
@@ -0,0 +1,100 @@
+"""
+This file runs the catalog under gunicorn, a pre-fork server
+
+Instead of Apache + mod_wsgi every worker process can be forked from one
+master that already imported the app (preloading): the code, templates and
+caches loaded at import are then shared copy-on-write between the workers
+instead of being loaded again by each of them
+
+Fork safety
+- Database connections must never be shared between processes. The master
+  closes its pools before forking (when_ready) and every child starts with
+  fresh pools (afterFork() in __init__.py, registered with
+  os.register_at_fork so it applies to any forking server)
+- Each worker then runs the warm-up (warmup.py) again, opening its own
+  connections before it takes requests
+
+Usage, from /var/www/catalog
+    CATALOG_SECRET_KEY=... python catalog/serve.py
+Settings (environment variables)
+    CATALOG_BIND       address to listen on (127.0.0.1:8000)
+    CATALOG_WORKERS    worker processes (2 x CPUs + 1)
+    CATALOG_THREADS    threads per worker (4)
+    CATALOG_PRELOAD    set to 0 to import the app in every worker instead (1)
+Compare setups with benchmarks/bench_prefork.py
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BIND = os.environ.get('CATALOG_BIND', '127.0.0.1:8000')
+WORKERS = int(os.environ.get('CATALOG_WORKERS',
+                             multiprocessing.cpu_count() * 2 + 1))
+THREADS = int(os.environ.get('CATALOG_THREADS', '4'))
+PRELOAD = os.environ.get('CATALOG_PRELOAD', '1') != '0'
+
+
+def load_app():
+    # Import the app as the 'catalog' package, like catalog.wsgi does
+    sys.path.insert(0, os.path.dirname(HERE))
+    from catalog import app
+    if os.environ.get('CATALOG_SECRET_KEY'):
+        app.secret_key = os.environ['CATALOG_SECRET_KEY']
+    return app
+
+
+def when_ready(server):
+    '''
+        Runs in the master once the app is loaded, before any worker forks.
+    '''
+    if 'catalog' in sys.modules:
+        catalog = sys.modules['catalog']
+        # The warm-up at import opened connections the workers can't use
+        catalog.session.remove()
+        engines = [catalog.engine, catalog.setup_engine]
+        for engine in engines + catalog.read_engines:
+            engine.dispose()
+    # Move everything imported so far out of the garbage collector's reach,
+    # so collections in the workers don't touch (and copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    catalog = sys.modules.get('catalog')
+    if catalog is not None and catalog.warmup.ENABLED:
+        catalog.worker_warmup.run()
+
+
+class CatalogServer(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return load_app()
+
+
+def options():
+    return {
+        'bind': BIND,
+        'workers': WORKERS,
+        'threads': THREADS,
+        'worker_class': 'gthread' if THREADS > 1 else 'sync',
+        'preload_app': PRELOAD,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+    }
+
+
+if __name__ == '__main__':
+    CatalogServer(options()).run()
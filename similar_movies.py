@@ -0,0 +1,363 @@
+"""
+This file builds the "similar titles" shown on a movie's page
+
+Comparing a movie with every other one on each page view is far too slow,
+so this job precomputes the K most similar movies of every movie into the
+movie_similar table, and get_movie/similar_json only look them up
+
+How similarity is computed
+- Every movie's name + description becomes a TF-IDF vector: words are
+  hashed into FEATURES buckets (no vocabulary to keep in memory), term
+  counts are dampened (1 + log tf), weighted by inverse document frequency
+  and the vector is normalised to length 1
+- The similarity of two movies is the dot product (cosine) of their vectors
+- The vectors of all movies live in one sparse matrix. Movies are scored in
+  batches of BATCH movies against blocks of BLOCK candidates, with a running
+  top K per movie kept between blocks, so the dense score matrix never gets
+  bigger than BATCH x BLOCK whatever the number of movies
+
+Usage (e.g. from cron every few minutes)
+    python similar_movies.py [--full]
+- Incremental by default: reads the change feed (change_feed.py) since the
+  last build and recomputes only the movies that changed, plus the movies
+  whose lists they enter or leave
+- Weights (IDF) are recomputed on every run but only the lists that are
+  recomputed pick them up, run --full now and then (e.g. nightly)
+
+Requirements
+    pip install numpy scipy
+The app itself doesn't need them, it only reads the table
+"""
+import argparse
+import datetime
+import math
+import re
+import time
+import zlib
+from array import array
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import bindparam, delete, func, select
+
+import change_feed
+from database_setup import Movie, MovieSimilar, SimilarBuild
+from proxy_cache import purge
+
+# Neighbours kept per movie
+K = 10
+# Scores below this aren't worth showing
+MIN_SCORE = 0.05
+# Hash buckets for words, collisions only blur rare words a little
+FEATURES = 2 ** 20
+# Movies scored at once, and candidates per block (BATCH x BLOCK float32s)
+BATCH = 256
+BLOCK = 50000
+# Movies read from the database at once
+READ_CHUNK = 10000
+# Incremental runs touching more movies than this just rebuild everything
+MAX_INCREMENTAL = 50000
+# Surrogate keys per purge request
+PURGE_KEYS = 100
+
+WORD = re.compile(r'[a-z0-9]+')
+STOP_WORDS = frozenset('''
+    a an and are as at be but by for from has he her his in is it its of on
+    or she that the their they this to was were with who will
+'''.split())
+
+table = MovieSimilar.__table__
+
+
+def tokenize(text):
+    return [word for word in WORD.findall((text or '').lower())
+            if len(word) > 1 and word not in STOP_WORDS]
+
+
+def feature(word):
+    # crc32 rather than hash(), which changes between processes
+    return zlib.crc32(word.encode('utf-8')) % FEATURES
+
+
+class Vectors(object):
+    '''
+        TF-IDF vectors of all movies.
+
+        Attributes
+            ids (ndarray): Movie ids, row i of matrix is movie ids[i]
+            rows (dict): Movie id -> row
+            matrix (csr_matrix): One L2-normalised row per movie
+    '''
+    def __init__(self, ids, matrix):
+        self.ids = ids
+        self.rows = dict((int(movie_id), row)
+                         for row, movie_id in enumerate(ids))
+        self.matrix = matrix
+        # Column blocks of the transpose, scoring multiplies batches by these
+        self.candidates = matrix.T.tocsc()
+
+    @classmethod
+    def load(cls, session):
+        '''
+            Reads every movie once, keeping only compact arrays.
+        '''
+        ids = array('q')
+        indptr = array('q', [0])
+        indices = array('i')
+        counts = array('f')
+
+        result = session.execute(
+            select(Movie.id, Movie.name, Movie.description)
+            .order_by(Movie.id)
+            .execution_options(stream_results=True))
+        for chunk in result.partitions(READ_CHUNK):
+            for movie_id, name, description in chunk:
+                terms = {}
+                for word in tokenize(name) + tokenize(description):
+                    bucket = feature(word)
+                    terms[bucket] = terms.get(bucket, 0) + 1
+                ids.append(movie_id)
+                indices.extend(terms.keys())
+                counts.extend(1 + math.log(count)
+                              for count in terms.values())
+                indptr.append(len(indices))
+
+        indices = np.frombuffer(indices, dtype=np.int32)
+        data = np.frombuffer(counts, dtype=np.float32).copy()
+        documents = len(ids)
+
+        # Inverse document frequency (smoothed), each bucket appears at most
+        # once per movie so counting indices counts documents
+        frequency = np.bincount(indices, minlength=FEATURES)
+        idf = (np.log((1.0 + documents) / (1.0 + frequency)) +
+               1.0).astype(np.float32)
+        data *= idf[indices]
+
+        matrix = sparse.csr_matrix(
+            (data, indices, np.frombuffer(indptr, dtype=np.int64)),
+            shape=(documents, FEATURES))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1))
+                        .ravel())
+        norms[norms == 0] = 1
+        matrix = sparse.diags(1 / norms).dot(matrix).astype(np.float32)
+        return cls(np.frombuffer(ids, dtype=np.int64), matrix.tocsr())
+
+    def top_k(self, rows, k=K):
+        '''
+            Finds the k most similar movies of some movies.
+
+            Params
+                rows (ndarray): Rows (not ids) of the movies to score
+                k (int): Neighbours to find
+
+            Returns
+                neighbours (list): Per row, [(similar_id, score), ...] best
+                    first
+        '''
+        queries = self.matrix[rows]
+        best_scores = np.full((len(rows), k), -1.0, dtype=np.float32)
+        best_rows = np.zeros((len(rows), k), dtype=np.int64)
+        positions = np.arange(len(rows))
+
+        for start in range(0, len(self.ids), BLOCK):
+            end = min(start + BLOCK, len(self.ids))
+            scores = queries.dot(self.candidates[:, start:end]).toarray()
+            # A movie isn't similar to itself
+            own = (rows >= start) & (rows < end)
+            scores[positions[own], rows[own] - start] = -1
+
+            # Top k of this block, then of block + best so far
+            take = min(k, end - start)
+            top = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+            merged_scores = np.hstack(
+                [best_scores, np.take_along_axis(scores, top, axis=1)])
+            merged_rows = np.hstack([best_rows, top + start])
+            keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+            best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [[(int(self.ids[row]), float(score))
+                 for row, score in zip(row_ids, row_scores)
+                 if score >= MIN_SCORE]
+                for row_ids, row_scores in zip(best_rows, best_scores)]
+
+    def beaten_by(self, movie_ids, thresholds):
+        '''
+            Finds the movies for which one of movie_ids scores above their
+            current threshold, i.e. would enter their neighbour list.
+
+            Params
+                movie_ids (list): Changed movies
+                thresholds (ndarray): Per row, the lowest score currently
+                    listed (MIN_SCORE when the list isn't full)
+
+            Returns
+                rows (set): Rows whose lists need recomputing
+        '''
+        columns = [self.rows[movie_id] for movie_id in movie_ids]
+        changed = self.matrix[columns].T.tocsc()
+        beaten = set()
+        for start in range(0, len(self.ids), BLOCK):
+            end = min(start + BLOCK, len(self.ids))
+            scores = self.matrix[start:end].dot(changed).toarray()
+            for column, row in enumerate(columns):
+                if start <= row < end:
+                    scores[row - start, column] = -1
+            hits = np.nonzero(scores.max(axis=1) > thresholds[start:end])[0]
+            beaten.update((hits + start).tolist())
+        return beaten
+
+
+def listed(session, movie_ids):
+    '''
+        Returns
+            lists (dict): movie_id -> stored [(similar_id, score)], as
+                similar.json shows them (scores rounded)
+    '''
+    lists = {}
+    for movie_id, similar_id, score in session.execute(
+            select(table.c.movie_id, table.c.similar_id, table.c.score)
+            .where(table.c.movie_id.in_(movie_ids))
+            .order_by(table.c.movie_id, table.c.rank)):
+        lists.setdefault(movie_id, []).append((similar_id, round(score, 3)))
+    return lists
+
+
+def store(session, vectors, rows):
+    '''
+        Recomputes the neighbour lists of some movies and replaces those
+        that changed, one transaction per batch.
+
+        Returns
+            changed (list): Ids of the movies whose lists were rewritten
+    '''
+    rows = np.asarray(sorted(rows), dtype=np.int64)
+    changed = []
+    for start in range(0, len(rows), BATCH):
+        batch = rows[start:start + BATCH]
+        movie_ids = [int(vectors.ids[row]) for row in batch]
+        try:
+            old = listed(session, movie_ids)
+            new = dict(zip(movie_ids, vectors.top_k(batch)))
+            # Unchanged lists are left alone, their pages stay cached
+            rewrite = [movie_id for movie_id in movie_ids
+                       if old.get(movie_id, []) !=
+                       [(similar_id, round(score, 3))
+                        for similar_id, score in new[movie_id]]]
+            values = [{'movie_id': movie_id, 'rank': rank,
+                       'similar_id': similar_id, 'score': score}
+                      for movie_id in rewrite
+                      for rank, (similar_id, score)
+                      in enumerate(new[movie_id])]
+            if rewrite:
+                session.execute(delete(table).where(
+                    table.c.movie_id.in_(rewrite)))
+            if values:
+                session.execute(table.insert(), values)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        changed += rewrite
+    return changed
+
+
+def affected_rows(session, vectors, upserted, deleted):
+    '''
+        Works out which lists an incremental run has to recompute.
+
+        Returns
+            rows (set): Rows of vectors to recompute
+    '''
+    changed = [movie_id for movie_id in upserted if movie_id in vectors.rows]
+    rows = set(vectors.rows[movie_id] for movie_id in changed)
+
+    # Lists that currently show a changed or deleted movie
+    gone = list(upserted) + list(deleted)
+    statement = (select(table.c.movie_id).distinct()
+                 .where(table.c.similar_id.in_(bindparam('ids',
+                                                         expanding=True))))
+    for start in range(0, len(gone), 500):
+        for movie_id, in session.execute(
+                statement, {'ids': gone[start:start + 500]}):
+            if movie_id in vectors.rows:
+                rows.add(vectors.rows[movie_id])
+
+    # Lists a changed movie would now enter
+    if changed:
+        thresholds = np.full(len(vectors.ids), MIN_SCORE, dtype=np.float32)
+        for movie_id, lowest, listed in session.execute(
+                select(table.c.movie_id, func.min(table.c.score),
+                       func.count())
+                .group_by(table.c.movie_id)):
+            if listed >= K and movie_id in vectors.rows:
+                thresholds[vectors.rows[movie_id]] = lowest
+        rows |= vectors.beaten_by(changed, thresholds)
+    return rows
+
+
+def build(session, full=False):
+    '''
+        Brings movie_similar up to date.
+
+        Params
+            session (Session): Database session to read and write through
+            full (bool): Recompute every list even if a build exists
+
+        Returns
+            stored (int): Number of neighbour lists that changed
+    '''
+    state = session.get(SimilarBuild, 1)
+    since = None if full or state is None else state.version
+    if since is None:
+        version = change_feed.current_version(session)
+    else:
+        version, upserted, deleted = change_feed.touched_since(session, since)
+        if version == since:
+            return 0
+        if len(upserted) + len(deleted) > MAX_INCREMENTAL:
+            since = None
+
+    vectors = Vectors.load(session)
+    if since is None:
+        rows = range(len(vectors.ids))
+        # Lists of movies deleted since are left behind by a full build
+        session.execute(delete(table).where(
+            table.c.movie_id.not_in(select(Movie.id))))
+    else:
+        rows = affected_rows(session, vectors, upserted, deleted)
+        if deleted:
+            session.execute(delete(table).where(
+                table.c.movie_id.in_(list(deleted))))
+    changed = store(session, vectors, rows)
+
+    if state is None:
+        state = SimilarBuild(id=1, version=version)
+        session.add(state)
+    state.version = version
+    state.built_at = datetime.datetime.utcnow()
+    session.commit()
+    # Only the pages of the movies whose lists changed show something new
+    for start in range(0, len(changed), PURGE_KEYS):
+        purge(['movie-%d' % movie_id
+               for movie_id in changed[start:start + PURGE_KEYS]])
+    return len(changed)
+
+
+if __name__ == '__main__':
+    from sqlalchemy.orm import sessionmaker
+    from database_setup import engine
+
+    parser = argparse.ArgumentParser(
+        description='Precompute similar movies')
+    parser.add_argument('--full', action='store_true',
+                        help='recompute every movie')
+    args = parser.parse_args()
+
+    start = time.time()
+    stored = build(sessionmaker(bind=engine)(), args.full)
+    print("Stored %d neighbour lists in %.1f s" % (stored,
+                                                   time.time() - start))
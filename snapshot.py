@@ -0,0 +1,214 @@
+"""
+This file exports the public catalog as a tree of static files
+
+The catalog is mostly read-only, yet every anonymous page view goes through
+Flask and SQLAlchemy. This renders what an anonymous visitor would get
+(home.html, publicgenre.html, publicmovie.html and the JSON endpoints) into
+plain files that Apache serves directly (see README)
+
+Layout, mirroring the app's URLs
+    <root>/current -> <root>/tree-<version>-<time>/   (symlink)
+        index.html, catalog/index.html          show_catalog
+        catalog.json                             catalog_json
+        catalog/<genre_id>/movies/index.html     show_movies
+        catalog/<genre_id>/movies.json           movies_json
+        catalog/<genre_id>/<movie_id>/index.html get_movie
+        catalog/<movie_id>.json                  solo_json
+        .version                                 change_feed version
+
+Usage (e.g. from cron every minute)
+    python snapshot.py [--full] [--root DIR]
+- Incremental by default: reads the change feed (change_feed.py) since the
+  current tree's version and only re-renders the movies and genres touched
+  since then, plus the genre list
+- Every run builds a NEW tree (hard linking unchanged files from the
+  current one) and then swaps the 'current' symlink in one rename, so Apache
+  never sees a half written tree
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import ratelimit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.environ.get('CATALOG_SNAPSHOT_ROOT', '/var/www/catalog/snapshot')
+
+# Old trees to keep around for requests still reading them
+KEEP_TREES = 2
+
+
+def write_file(tree, path, data):
+    '''
+        Writes a file through a temporary name, so a hard linked copy shared
+        with the previous tree is replaced rather than modified.
+    '''
+    target = os.path.join(tree, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(target + '.tmp', target)
+
+
+def remove_file(tree, path):
+    try:
+        os.remove(os.path.join(tree, path))
+    except FileNotFoundError:
+        pass
+
+
+class Exporter(object):
+    '''
+        Renders URLs of the app into a tree with an anonymous test client,
+        so the files are byte-for-byte what the app itself would send.
+    '''
+    def __init__(self, app, tree):
+        self.client = app.test_client()
+        # Thousands of JSON renders mustn't count against the rate limits
+        self.client.environ_base[ratelimit.INTERNAL] = True
+        self.tree = tree
+        self.rendered = 0
+
+    def render(self, url, path):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError("%s answered %s" % (url, response.status))
+        write_file(self.tree, path, response.data)
+        self.rendered += 1
+
+    def genre_list(self):
+        self.render('/', 'index.html')
+        self.render('/catalog/', 'catalog/index.html')
+        self.render('/catalog.json', 'catalog.json')
+
+    def genre(self, genre_id):
+        self.render('/catalog/%d/movies/' % genre_id,
+                    'catalog/%d/movies/index.html' % genre_id)
+        self.render('/catalog/%d/movies.json' % genre_id,
+                    'catalog/%d/movies.json' % genre_id)
+
+    def movie(self, genre_id, movie_id):
+        self.render('/catalog/%d/%d/' % (genre_id, movie_id),
+                    'catalog/%d/%d/index.html' % (genre_id, movie_id))
+        self.render('/catalog/%d.json' % movie_id,
+                    'catalog/%d.json' % movie_id)
+
+    def drop_movie(self, genre_id, movie_id):
+        shutil.rmtree(os.path.join(self.tree, 'catalog/%d/%d' %
+                                   (genre_id, movie_id)), ignore_errors=True)
+        remove_file(self.tree, 'catalog/%d.json' % movie_id)
+
+
+def current_tree(root):
+    link = os.path.join(root, 'current')
+    return os.path.realpath(link) if os.path.islink(link) else None
+
+
+def read_version(tree):
+    try:
+        with open(os.path.join(tree, '.version')) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def swap(root, tree):
+    '''
+        Points <root>/current at tree atomically and prunes old trees.
+    '''
+    link = os.path.join(root, 'current')
+    os.symlink(os.path.basename(tree), link + '.tmp')
+    os.replace(link + '.tmp', link)
+
+    trees = sorted((name for name in os.listdir(root)
+                    if name.startswith('tree-')),
+                   key=lambda name: os.path.getmtime(os.path.join(root, name)))
+    for name in trees[:-KEEP_TREES - 1]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def export(app, session, root=ROOT, full=False):
+    '''
+        Builds a new snapshot tree and makes it current.
+
+        Params
+            app (Flask): The catalog app
+            session (Session): Database session to read the feed through
+            root (str): Directory holding the trees and the current symlink
+            full (bool): Re-render everything even if a tree exists
+
+        Returns
+            rendered (int): Number of files rendered
+    '''
+    from change_feed import current_version, touched_since
+    from database_setup import Genre, Movie, MovieArchive
+    from sqlalchemy import select
+
+    os.makedirs(root, exist_ok=True)
+    previous = current_tree(root)
+    since = None if full or previous is None else read_version(previous)
+
+    if since is None:
+        version = current_version(session)
+    else:
+        version, upserted, deleted = touched_since(session, since)
+        if version == since:
+            return 0
+
+    tree = os.path.join(root, 'tree-%d-%d' % (version, time.time() * 1000))
+    exporter = Exporter(app, tree)
+
+    if since is None:
+        os.makedirs(tree)
+        for genre_id, in session.query(Genre.id):
+            exporter.genre(genre_id)
+        for genre_id, movie_id in session.query(Movie.genre_id, Movie.id):
+            exporter.movie(genre_id, movie_id)
+        # The app still serves archived movies (see movie_archive.py)
+        for genre_id, movie_id in session.query(MovieArchive.genre_id,
+                                                MovieArchive.id):
+            exporter.movie(genre_id, movie_id)
+    else:
+        # Unchanged files are shared with the previous tree
+        shutil.copytree(previous, tree, copy_function=os.link)
+        # Archiving logs deletes too (movie_archive.py), but the app still
+        # serves those movies' own pages
+        archived = set()
+        for start in range(0, len(deleted), 500):
+            archived.update(session.execute(
+                select(MovieArchive.id).where(MovieArchive.id.in_(
+                    list(deleted)[start:start + 500]))).scalars())
+        for movie_id, genre_id in deleted.items():
+            if movie_id in archived:
+                exporter.movie(genre_id, movie_id)
+            else:
+                exporter.drop_movie(genre_id, movie_id)
+        for movie_id, genre_id in upserted.items():
+            exporter.movie(genre_id, movie_id)
+        for genre_id in set(upserted.values()) | set(deleted.values()):
+            exporter.genre(genre_id)
+    exporter.genre_list()
+
+    write_file(tree, '.version', str(version).encode())
+    swap(root, tree)
+    session.remove()
+    return exporter.rendered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the public catalog as static files')
+    parser.add_argument('--full', action='store_true',
+                        help='re-render everything')
+    parser.add_argument('--root', default=ROOT)
+    args = parser.parse_args()
+
+    # Import the app as the 'catalog' package, like catalog.wsgi does
+    sys.path.insert(0, os.path.dirname(HERE))
+    from catalog import app, session
+
+    start = time.time()
+    rendered = export(app, session, args.root, args.full)
+    print("Rendered %d files in %.1f s" % (rendered, time.time() - start))
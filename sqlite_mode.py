@@ -0,0 +1,115 @@
+"""
+This file tunes SQLite for serving the catalog on a single server
+
+catalog.db and lotsofitems.py use SQLite, and small deployments can run on
+it too, but SQLAlchemy's defaults are made for scripts: a rollback journal
+(every write blocks every reader), a full fsync per commit, a 2 MB page
+cache per connection, and writes that start as reads and then fail with
+'database is locked' when two try to upgrade at once. For a file database
+(CATALOG_DATABASE_URL=sqlite:////path/catalog.db) the app instead uses
+
+One writer, many readers
+- writer(): the engine writes go to (the 'primary' of RoutingSession). Its
+  pool holds ONE connection, so the threads of a process queue for it in
+  the pool instead of spinning on SQLite's lock, and every transaction
+  starts with BEGIN IMMEDIATE, taking the write lock up front. Processes
+  (mod_wsgi daemons, gunicorn workers) wait for each other up to
+  CATALOG_SQLITE_BUSY_MS
+- reader(): a pool of read-only (query_only) connections that RoutingSession
+  sends the reads to, as if it was a replica. In WAL mode they never wait
+  for the writer and always see the last commit, so users aren't pinned to
+  the writer after they wrote something
+
+Pragmas, on every connection
+    journal_mode=WAL       readers and the writer don't block each other
+    synchronous=NORMAL     fsync at checkpoints, not on every commit (a power
+                           loss can lose the last commits, never corrupts)
+    cache_size             CATALOG_SQLITE_CACHE_MB per connection (32)
+    mmap_size              CATALOG_SQLITE_MMAP_MB (256): reads come from the
+                           OS page cache, shared by all processes
+    busy_timeout           CATALOG_SQLITE_BUSY_MS (5000)
+    temp_store=MEMORY      sorts and temporary tables in memory
+
+Set CATALOG_SQLITE_TUNING=0 for SQLAlchemy's defaults.
+benchmarks/bench_sqlite.py compares both, and Postgres
+"""
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+ENABLED = os.environ.get('CATALOG_SQLITE_TUNING', '1') != '0'
+CACHE_MB = int(os.environ.get('CATALOG_SQLITE_CACHE_MB', '32'))
+MMAP_MB = int(os.environ.get('CATALOG_SQLITE_MMAP_MB', '256'))
+BUSY_MS = int(os.environ.get('CATALOG_SQLITE_BUSY_MS', '5000'))
+
+
+def applies(url):
+    '''
+        Returns
+            tuned (bool): True for a SQLite file database (not :memory:)
+                with tuning enabled
+    '''
+    url = make_url(url)
+    return (ENABLED and url.get_backend_name() == 'sqlite' and
+            url.database not in (None, '', ':memory:'))
+
+
+def pragmas(read_only):
+    statements = [
+        'PRAGMA busy_timeout = %d' % BUSY_MS,
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -%d' % (CACHE_MB * 1024),
+        'PRAGMA mmap_size = %d' % (MMAP_MB * 1024 * 1024),
+        'PRAGMA temp_store = MEMORY',
+    ]
+    if read_only:
+        statements.append('PRAGMA query_only = ON')
+    else:
+        # Stored in the file, the readers pick it up from there
+        statements.insert(1, 'PRAGMA journal_mode = WAL')
+    return statements
+
+
+def tuned_engine(url, read_only, **options):
+    # SQLAlchemy doesn't pool SQLite file connections by default. Pooled
+    # connections move between threads, one at a time
+    options.setdefault('poolclass', QueuePool)
+    options.setdefault('connect_args', {})['check_same_thread'] = False
+    engine = create_engine(url, **options)
+    statements = pragmas(read_only)
+    begin = 'BEGIN' if read_only else 'BEGIN IMMEDIATE'
+
+    @event.listens_for(engine, 'connect')
+    def configure(dbapi_connection, connection_record):
+        # Take transactions out of the driver's hands (it would BEGIN
+        # DEFERRED only before the first write), see 'begin' below
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin_transaction(connection):
+        connection.exec_driver_sql(begin)
+
+    return engine
+
+
+def writer(url, **options):
+    '''
+        Returns
+            engine (Engine): The single connection engine for writes
+    '''
+    options.update(pool_size=1, max_overflow=0)
+    return tuned_engine(url, False, **options)
+
+
+def reader(url, **options):
+    '''
+        Returns
+            engine (Engine): A pool of read-only connections
+    '''
+    return tuned_engine(url, True, **options)
@@ -0,0 +1,158 @@
+"""
+This file fingerprints and precompresses the files in static/
+
+Without it every page view makes a conditional request per asset
+(styles.css, google_icon.png) just to learn that nothing changed. With it
+each asset gets a URL that contains a hash of its content, so the URL changes
+whenever the file does and browsers can cache it forever
+
+Build step (run on every deploy, after pulling new static files)
+    python static_assets.py
+- Copies every file in static/ to static/dist/<name>.<hash>.<ext>
+- Writes .gz (and .br when the brotli package is installed) next to the
+  text based ones
+- Writes static/dist/manifest.json mapping 'styles.css' to its hashed name
+
+At runtime init_app()
+- Overrides url_for() in the templates so url_for('static', ...) points at
+  the hashed copy (falls back to the plain file if it isn't in the manifest)
+- Serves /static/dist/ with far-future immutable Cache-Control headers,
+  picking the precompressed copy the browser accepts
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import sys
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always built
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# Only text formats are worth compressing, images already are
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+# One year, the longest lifetime browsers honour
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def fingerprint(path):
+    '''
+        Returns the first 12 hex characters of the file's sha256.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def build(static_dir):
+    '''
+        Fingerprints and precompresses everything in static_dir.
+
+        Old hashed copies are left in place so pages that are still cached
+        somewhere keep working.
+
+        Params
+            static_dir (str): Path of the static folder
+
+        Returns
+            manifest (dict): Original filename -> hashed filename (relative
+                to static_dir)
+    '''
+    dist_dir = os.path.join(static_dir, DIST)
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {}
+
+    for root, dirs, files in os.walk(static_dir):
+        # Don't fingerprint our own output
+        if os.path.abspath(root) == os.path.abspath(static_dir):
+            dirs[:] = [d for d in dirs if d != DIST]
+
+        for name in files:
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            stem, ext = os.path.splitext(relative)
+            hashed = '%s.%s%s' % (stem, fingerprint(source), ext)
+            target = os.path.join(dist_dir, hashed)
+
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(source, target)
+                if ext in COMPRESSIBLE:
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                    with open(target + '.gz', 'wb') as f:
+                        # mtime=0 keeps the output byte-for-byte reproducible
+                        f.write(gzip.compress(data, 9, mtime=0))
+                    if brotli is not None:
+                        with open(target + '.br', 'wb') as f:
+                            f.write(brotli.compress(data))
+
+            manifest[relative] = DIST + '/' + hashed
+
+    # Write the manifest last and atomically, so a running app never sees a
+    # manifest pointing at files that don't exist yet
+    path = os.path.join(dist_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, DIST, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def init_app(app):
+    '''
+        Hooks the hashed assets into a Flask app (see module docstring).
+    '''
+    dist_dir = os.path.join(app.static_folder, DIST)
+    manifest = load_manifest(app.static_folder)
+
+    def asset_url_for(endpoint, **values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+        return url_for(endpoint, **values)
+
+    def send_asset(filename):
+        mimetype = mimetypes.guess_type(filename)[0]
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if (request.accept_encodings[candidate] and
+                    os.path.isfile(os.path.join(dist_dir, filename + suffix))):
+                encoding = candidate
+                filename += suffix
+                break
+
+        response = send_from_directory(dist_dir, filename, mimetype=mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+    app.jinja_env.globals['url_for'] = asset_url_for
+    app.add_url_rule(app.static_url_path + '/' + DIST + '/<path:filename>',
+                     'static_asset', send_asset)
+
+
+if __name__ == '__main__':
+    static_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static')
+    for name, hashed in sorted(build(static_dir).items()):
+        print("%s -> %s" % (name, hashed))
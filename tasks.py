@@ -0,0 +1,221 @@
+"""
+This file runs non-critical work in the background, off the request path
+
+Some side effects of a request don't have to happen before the response:
+revoking a token at Google/Facebook on logout, purging the proxy cache after
+a write, ... Doing them inline makes the user wait for a third party. Instead
+the request enqueues a job and a background worker runs it
+
+Jobs
+- A job is a function registered under a name with @task('name'), called
+  with the keyword arguments given to enqueue() (they must be JSON-able)
+- Jobs are rows in the 'task' table, so they survive restarts and any
+  process can run them. A job runs at least once: if it raises it is retried
+  with exponential backoff, and after ATTEMPTS failures it's kept with state
+  'failed' and its last error for someone to look at
+- A worker claims a job by setting locked_until with a conditional UPDATE
+  (like update_owned_movie in movie_writes.py), so two workers never run the
+  same job at once; a job whose worker died is picked up after LEASE seconds
+
+Workers
+- Every app process runs a worker thread, started by its first enqueue() and
+  woken up right away by it; it also polls every POLL seconds for retries
+  and jobs enqueued by other processes
+- Or run dedicated workers next to the app (CATALOG_TASK_THREAD=0)
+      python tasks.py
+
+Settings (environment variables)
+    CATALOG_TASK_THREAD     set to 0 for no worker thread in the app (1)
+    CATALOG_TASK_POLL       seconds between polls (5)
+    CATALOG_TASK_ATTEMPTS   attempts before a job is marked failed (8)
+"""
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import traceback
+
+from sqlalchemy import and_, or_, select, update
+
+from database_setup import Task
+
+THREAD = os.environ.get('CATALOG_TASK_THREAD', '1') != '0'
+POLL = float(os.environ.get('CATALOG_TASK_POLL', '5'))
+ATTEMPTS = int(os.environ.get('CATALOG_TASK_ATTEMPTS', '8'))
+# How long a claimed job is reserved for its worker
+LEASE = 300
+# Retry after 2, 4, 8, ... seconds, at most an hour
+BACKOFF = 2
+MAX_BACKOFF = 3600
+
+table = Task.__table__
+log = logging.getLogger(__name__)
+
+registry = {}
+state = {'session_factory': None, 'thread': None, 'pid': None}
+starting = threading.Lock()
+wake_up = threading.Event()
+
+
+def task(name):
+    '''
+        Registers a function as the job called name.
+    '''
+    def register(function):
+        registry[name] = function
+        return function
+    return register
+
+
+def configure(session_factory):
+    '''
+        Tells the worker how to open database sessions (it needs its own,
+        on the primary).
+    '''
+    state['session_factory'] = session_factory
+
+
+def enqueue(session, name, **payload):
+    '''
+        Queues a job and commits.
+
+        Params
+            session (Session): Database session to write the job through
+            name (str): Name the job was registered under
+            payload: Keyword arguments for the job
+    '''
+    if name not in registry:
+        raise KeyError("Unknown task %s" % name)
+    try:
+        session.execute(table.insert().values(
+            name=name, payload=json.dumps(payload), state='queued',
+            attempts=0, run_at=datetime.datetime.utcnow(),
+            created_at=datetime.datetime.utcnow()))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    if THREAD:
+        ensure_worker()
+        wake_up.set()
+
+
+def claim(session):
+    '''
+        Reserves the next due job.
+
+        Returns
+            job (Row): id, name, payload and attempts, None if nothing is due.
+                No transaction is left open either way: the job runs
+                without holding a connection's transaction (on SQLite the
+                database's write lock)
+    '''
+    now = datetime.datetime.utcnow()
+    available = and_(table.c.state == 'queued', table.c.run_at <= now,
+                     or_(table.c.locked_until.is_(None),
+                         table.c.locked_until < now))
+    candidates = session.execute(
+        select(table.c.id).where(available)
+        .order_by(table.c.run_at).limit(10)).scalars().all()
+    for job_id in candidates:
+        # Only one worker's UPDATE can still match
+        claimed = session.execute(
+            update(table)
+            .where(and_(table.c.id == job_id, available))
+            .values(locked_until=now + datetime.timedelta(seconds=LEASE),
+                    attempts=table.c.attempts + 1))
+        job = None
+        if claimed.rowcount == 1:
+            job = session.execute(
+                select(table.c.id, table.c.name, table.c.payload,
+                       table.c.attempts)
+                .where(table.c.id == job_id)).one()
+        session.commit()
+        if job is not None:
+            return job
+    # Ends the transaction of the candidates query
+    session.rollback()
+    return None
+
+
+def run_one(session):
+    '''
+        Claims and runs one job.
+
+        Returns
+            ran (bool): False if no job was due
+    '''
+    job = claim(session)
+    if job is None:
+        return False
+
+    try:
+        registry[job.name](**json.loads(job.payload))
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= ATTEMPTS:
+            log.error("Task %s #%d failed for good: %s", job.name, job.id,
+                      error)
+            values = {'state': 'failed'}
+        else:
+            delay = min(BACKOFF * 2 ** (job.attempts - 1), MAX_BACKOFF)
+            # Jitter, so jobs that failed together don't retry together
+            delay *= random.uniform(0.8, 1.2)
+            log.warning("Task %s #%d failed, retrying in %.0f s: %s",
+                        job.name, job.id, delay, error)
+            values = {'run_at': datetime.datetime.utcnow() +
+                      datetime.timedelta(seconds=delay)}
+        session.execute(update(table).where(table.c.id == job.id)
+                        .values(locked_until=None, last_error=error,
+                                **values))
+    else:
+        session.execute(table.delete().where(table.c.id == job.id))
+    session.commit()
+    return True
+
+
+def work(stop=None):
+    '''
+        Runs jobs until stop (an Event) is set, sleeping between polls.
+    '''
+    while stop is None or not stop.is_set():
+        session = state['session_factory']()
+        try:
+            while run_one(session):
+                pass
+        except Exception:
+            log.exception("Task worker error")
+            session.rollback()
+        finally:
+            session.close()
+        wake_up.wait(POLL)
+        wake_up.clear()
+
+
+def ensure_worker():
+    '''
+        Starts this process's worker thread, once per process (a thread of
+        a parent process doesn't survive a fork).
+    '''
+    with starting:
+        if state['pid'] == os.getpid() and state['thread'].is_alive():
+            return
+        state['pid'] = os.getpid()
+        state['thread'] = threading.Thread(target=work, name='task-worker',
+                                           daemon=True)
+        state['thread'].start()
+
+
+if __name__ == '__main__':
+    # Import the app as the 'catalog' package, like catalog.wsgi does; that
+    # registers its jobs and calls configure()
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(here))
+    logging.basicConfig(level=logging.INFO)
+    import catalog  # noqa: F401
+    # This file runs as __main__, the app's registry is in the 'tasks' module
+    import tasks
+    tasks.work()
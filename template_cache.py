@@ -0,0 +1,88 @@
+"""
+This file keeps compiled Jinja templates on disk
+
+Normally every fresh mod_wsgi worker parses and compiles each template the
+first time it renders it, so the first requests after an Apache restart are
+slow. With a filesystem bytecode cache a worker only has to load the already
+compiled code, and precompiling at deploy time means no worker ever compiles
+
+Deploy step (after pulling new templates)
+    python template_cache.py
+- Compiles every template in templates/ into the cache directory
+- The cache is keyed on the template source, so edited templates are simply
+  recompiled, stale entries are never used
+
+The cache directory should be writable by the Apache user
+    CATALOG_TEMPLATE_CACHE   (default: .jinja-cache next to this file)
+If it isn't, the app still works: with a warning in the log, workers use
+what's in the cache without adding to it, or compile in memory when the
+directory can't even be created
+"""
+import logging
+import os
+import sys
+import time
+
+from flask import Flask
+from jinja2 import FileSystemBytecodeCache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get('CATALOG_TEMPLATE_CACHE',
+                           os.path.join(HERE, '.jinja-cache'))
+
+log = logging.getLogger(__name__)
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    '''
+        A FileSystemBytecodeCache that doesn't fail the render when a
+        compiled template can't be written, it stays compiled in memory.
+    '''
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            log.warning("Can't write to the template cache %s: %s",
+                        self.directory, e)
+
+
+def init_app(app, directory=CACHE_DIR):
+    '''
+        Makes the app's Jinja environment read and write compiled templates
+        from directory, creating it if needed. Without a directory the
+        templates are compiled in memory as usual.
+    '''
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        log.warning("No template cache, can't create %s: %s", directory, e)
+        return
+    app.jinja_env.bytecode_cache = BytecodeCache(directory)
+
+
+def precompile(app):
+    '''
+        Compiles (or loads from the bytecode cache) every template the app
+        knows about.
+
+        Params
+            app (Flask): App whose Jinja environment to fill
+
+        Returns
+            timings (dict): Template name -> seconds spent loading it
+    '''
+    timings = {}
+    for name in app.jinja_env.list_templates():
+        start = time.perf_counter()
+        app.jinja_env.get_template(name)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+if __name__ == '__main__':
+    # A bare app with the same root path compiles the templates exactly like
+    # __init__.py's app would, without connecting to the database
+    app = Flask('catalog', root_path=HERE)
+    init_app(app, sys.argv[1] if len(sys.argv) > 1 else CACHE_DIR)
+    for name, seconds in sorted(precompile(app).items()):
+        print("%-20s %6.1f ms" % (name, seconds * 1000))
@@ -0,0 +1,86 @@
+"""
+Shared test setup
+
+The modules read their settings from environment variables when they're
+imported, so point them at a throwaway SQLite database (and switch off the
+background threads, the rate limit store and the warm-up) before any of
+them is imported. Every test starts from empty tables
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+TMP = tempfile.mkdtemp(prefix='catalog-tests-')
+
+os.environ['CATALOG_DATABASE_URL'] = 'sqlite:///%s' % os.path.join(
+    TMP, 'catalog.db')
+os.environ['CATALOG_REPLICA_URLS'] = ''
+os.environ['CATALOG_TASK_THREAD'] = '0'
+os.environ['CATALOG_WARMUP'] = '0'
+os.environ['CATALOG_RATE_LIMIT_STORE'] = 'off'
+os.environ['CATALOG_AVATAR_DIR'] = os.path.join(TMP, 'avatars')
+os.environ['CATALOG_TEMPLATE_CACHE'] = os.path.join(TMP, 'jinja-cache')
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database_setup import Base, Genre, User, engine  # noqa: E402
+
+# The app reads its OAuth client ids from here when it's imported
+SECRETS = '/var/www/catalog/catalog/client_secrets.json'
+
+
+@pytest.fixture(autouse=True)
+def empty_tables():
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+        connection.execute(text('DELETE FROM sqlite_sequence'))
+    yield
+
+
+@pytest.fixture
+def session():
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def owner(session):
+    '''
+        Returns
+            user_id, genre_id (int): A user and a genre of theirs
+    '''
+    user = User(name='Owner', email='owner@example.com')
+    session.add(user)
+    session.commit()
+    genre = Genre(name='Drama', user_id=user.id)
+    session.add(genre)
+    session.commit()
+    return user.id, genre.id
+
+
+@pytest.fixture(scope='session')
+def catalog():
+    '''
+        Returns
+            catalog (module): The app package, imported as 'catalog' like
+                catalog.wsgi does
+    '''
+    if not os.path.exists(SECRETS):
+        pytest.skip('the app needs %s' % SECRETS)
+    if 'catalog' not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            'catalog', os.path.join(ROOT, '__init__.py'),
+            submodule_search_locations=[ROOT])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['catalog'] = module
+        spec.loader.exec_module(module)
+    return sys.modules['catalog']
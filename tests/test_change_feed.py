@@ -0,0 +1,71 @@
+import change_feed
+from movie_writes import (
+    apply_movie_batch,
+    create_movie,
+    delete_owned_movie,
+    update_owned_movie
+)
+
+
+def test_versions_follow_the_writes(session, owner):
+    user_id, genre_id = owner
+    first = create_movie(session, genre_id, user_id, 'A')
+    second = create_movie(session, genre_id, user_id, 'B')
+    update_owned_movie(session, first, user_id, 1, name='A2')
+
+    changes, version, more = change_feed.changes_since(session, 0)
+    assert [(change['id'], change['name']) for change in changes] == [
+        (second, 'B'), (first, 'A2')]
+    assert [change['version'] for change in changes] == [2, 3]
+    assert (version, more) == (3, False)
+
+
+def test_movie_changed_twice_shows_up_once(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'A')
+    update_owned_movie(session, movie_id, user_id, 1, name='A2')
+    update_owned_movie(session, movie_id, user_id, 2, name='A3')
+
+    changes, version, more = change_feed.changes_since(session, 0)
+    assert len(changes) == 1
+    assert changes[0]['name'] == 'A3'
+    assert changes[0]['genre_id'] == genre_id
+
+
+def test_deletes_are_tombstones(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'A')
+    since = change_feed.current_version(session)
+    delete_owned_movie(session, movie_id, user_id)
+
+    changes, version, more = change_feed.changes_since(session, since)
+    assert changes == [{'id': movie_id, 'deleted': True, 'version': version}]
+
+
+def test_pages_continue_where_they_stopped(session, owner):
+    user_id, genre_id = owner
+    results = apply_movie_batch(session, user_id, [
+        {'op': 'create', 'genre_id': genre_id, 'name': 'M%d' % i}
+        for i in range(5)])
+    ids = [result['id'] for result in results]
+
+    seen, since, more = [], 0, True
+    while more:
+        changes, since, more = change_feed.changes_since(session, since,
+                                                         limit=2)
+        seen += [change['id'] for change in changes]
+    assert seen == ids
+    assert since == change_feed.current_version(session)
+    assert change_feed.changes_since(session, since) == ([], since, False)
+
+
+def test_touched_since_keeps_the_last_op(session, owner):
+    user_id, genre_id = owner
+    kept = create_movie(session, genre_id, user_id, 'A')
+    gone = create_movie(session, genre_id, user_id, 'B')
+    delete_owned_movie(session, gone, user_id)
+
+    version, upserted, deleted = change_feed.touched_since(session, 0)
+    assert version == change_feed.current_version(session)
+    assert upserted == {kept: genre_id}
+    assert deleted == {gone: genre_id}
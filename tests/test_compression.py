@@ -0,0 +1,72 @@
+import gzip
+
+import pytest
+
+import compression
+from compression import CompressionMiddleware, accepted_encodings
+
+
+def choose(header):
+    return CompressionMiddleware(None).choose_encoding(
+        {'HTTP_ACCEPT_ENCODING': header})
+
+
+@pytest.fixture
+def no_brotli(monkeypatch):
+    monkeypatch.setattr(compression, 'brotli', None)
+
+
+def test_accepted_encodings_keeps_refused_codings():
+    assert accepted_encodings('gzip;q=0.5, BR, *;q=0, deflate;q=x') == {
+        'gzip': 0.5, 'br': 1.0, '*': 0.0, 'deflate': 0.0}
+
+
+@pytest.mark.parametrize('header, encoding', [
+    ('gzip', 'gzip'),
+    ('gzip, deflate', 'gzip'),
+    ('*', 'gzip'),
+    ('gzip;q=0', None),
+    # The coding's own q=0 wins over the wildcard
+    ('*, gzip;q=0', None),
+    ('gzip;q=0, *', None),
+    ('*;q=0, gzip', 'gzip'),
+    ('*;q=0', None),
+    ('identity', None),
+    ('', None),
+    ('br', None),
+])
+def test_choose_encoding(no_brotli, header, encoding):
+    assert choose(header) == encoding
+
+
+@pytest.mark.parametrize('header, encoding', [
+    ('br, gzip', 'br'),
+    ('br;q=0, gzip', 'gzip'),
+    ('br;q=0, *', 'gzip'),
+    # brotli only when asked for by name
+    ('*', 'gzip'),
+])
+def test_choose_brotli(monkeypatch, header, encoding):
+    # Only whether the package is there matters for the choice
+    monkeypatch.setattr(compression, 'brotli', object())
+    assert choose(header) == encoding
+
+
+def test_compresses_large_text_bodies(no_brotli):
+    body = b'<p>movie</p>' * 100
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [body]
+
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['headers'] = dict(headers)
+
+    middleware = CompressionMiddleware(app, min_size=500)
+    data = b''.join(middleware({'HTTP_ACCEPT_ENCODING': 'gzip'},
+                               start_response))
+    assert captured['headers']['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in captured['headers']['Vary']
+    assert gzip.decompress(data) == body
@@ -0,0 +1,86 @@
+import sqlite3
+
+from sqlalchemy import create_engine, inspect, text
+
+from database_setup import Base, has_unique_email, upgrade
+
+# The tables as the first version of the app created them
+OLD_SCHEMA = '''
+CREATE TABLE user (name VARCHAR(250) NOT NULL, email VARCHAR(250) NOT NULL,
+    picture VARCHAR(250), id INTEGER NOT NULL, PRIMARY KEY (id));
+CREATE TABLE genre (name VARCHAR(80) NOT NULL, id INTEGER NOT NULL,
+    user_id INTEGER, PRIMARY KEY (id));
+CREATE TABLE movie (name VARCHAR(80) NOT NULL, id INTEGER NOT NULL,
+    description VARCHAR(250), genre_id INTEGER, user_id INTEGER,
+    PRIMARY KEY (id));
+INSERT INTO user (id, name, email) VALUES (1, 'Ann', 'ann@example.com'),
+    (2, 'Bob', 'bob@example.com'), (3, 'Ann again', 'ann@example.com');
+INSERT INTO genre (id, name, user_id) VALUES (1, 'Drama', 3);
+INSERT INTO movie (id, name, genre_id, user_id) VALUES (1, 'A', 1, 1),
+    (2, 'B', 1, 3), (3, 'C', 1, 2);
+'''
+
+
+def old_database(tmp_path):
+    path = str(tmp_path / 'old.db')
+    connection = sqlite3.connect(path)
+    connection.executescript(OLD_SCHEMA)
+    connection.close()
+    engine = create_engine('sqlite:///%s' % path)
+    # What importing database_setup does before upgrading
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def test_upgrade_merges_users_sharing_an_email(tmp_path):
+    engine = old_database(tmp_path)
+    upgrade(engine)
+
+    with engine.connect() as connection:
+        assert has_unique_email(connection)
+        assert connection.execute(text(
+            'SELECT id, email FROM user ORDER BY id')).all() == [
+                (1, 'ann@example.com'), (2, 'bob@example.com')]
+        assert connection.execute(text(
+            'SELECT user_id FROM genre')).scalars().all() == [1]
+        assert connection.execute(text(
+            'SELECT user_id FROM movie ORDER BY id')).scalars().all() == [
+                1, 1, 2]
+
+
+def test_upgrade_adds_the_version_column(tmp_path):
+    engine = old_database(tmp_path)
+    upgrade(engine)
+
+    with engine.connect() as connection:
+        columns = [column['name']
+                   for column in inspect(connection).get_columns('movie')]
+        assert 'version' in columns
+        assert connection.execute(text(
+            'SELECT version FROM movie')).scalars().all() == [1, 1, 1]
+
+
+def test_upgrade_reserves_archived_ids(tmp_path):
+    engine = old_database(tmp_path)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO movie_archive (id, genre_id, user_id, version, "
+            "data, archived_at) VALUES (9, 1, 1, 1, x'00', '2020-01-01')"))
+    upgrade(engine)
+
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO movie (name) VALUES ('New')"))
+        assert connection.execute(text(
+            "SELECT id FROM movie WHERE name = 'New'")).scalar() == 10
+
+
+def test_upgrade_twice_changes_nothing(tmp_path):
+    engine = old_database(tmp_path)
+    upgrade(engine)
+    with engine.connect() as connection:
+        before = connection.execute(text(
+            "SELECT sql FROM sqlite_master ORDER BY name")).all()
+    upgrade(engine)
+    with engine.connect() as connection:
+        assert connection.execute(text(
+            "SELECT sql FROM sqlite_master ORDER BY name")).all() == before
@@ -0,0 +1,100 @@
+import datetime
+
+from database_setup import Movie, MovieArchive, MovieChange, User
+import change_feed
+import genre_stats
+import movie_archive
+from movie_writes import create_movie
+
+
+def age(session, *movie_ids):
+    session.query(MovieChange).filter(
+        MovieChange.movie_id.in_(movie_ids)).update(
+            {'changed_at': datetime.datetime(2000, 1, 1)},
+            synchronize_session=False)
+    session.commit()
+
+
+def test_pack_round_trip():
+    data = movie_archive.pack(u'Amélie', u'Paris, 1997 — ' * 10)
+    assert movie_archive.unpack(data) == (u'Amélie',
+                                          u'Paris, 1997 — ' * 10)
+    assert movie_archive.unpack(movie_archive.pack('A', None)) == ('A', None)
+
+
+def test_archive_and_restore_round_trip(session, owner):
+    user_id, genre_id = owner
+    cold = create_movie(session, genre_id, user_id, 'Old', 'black & white')
+    warm = create_movie(session, genre_id, user_id, 'New')
+    age(session, cold)
+
+    assert movie_archive.archive(session, days=30) == {genre_id: 1}
+    assert session.query(Movie.id).all() == [(warm,)]
+    assert genre_stats.movie_count(session, genre_id) == 1
+    changes, version, more = change_feed.changes_since(session, 2)
+    assert changes == [{'id': cold, 'deleted': True, 'version': version}]
+
+    # The page still works from the archive
+    movie = movie_archive.load(session, cold)
+    assert (movie.name, movie.description, movie.user_id) == (
+        'Old', 'black & white', user_id)
+
+    assert movie_archive.unarchive(session, cold, user_id) == 'restored'
+    movie = session.get(Movie, cold)
+    assert (movie.name, movie.description, movie.genre_id,
+            movie.version) == ('Old', 'black & white', genre_id, 1)
+    assert session.query(MovieArchive).count() == 0
+    assert genre_stats.movie_count(session, genre_id) == 2
+    changes, version, more = change_feed.changes_since(session, version)
+    assert [(change['id'], change['name']) for change in changes] == [
+        (cold, 'Old')]
+
+
+def test_movies_without_changes_are_kept(session, owner):
+    user_id, genre_id = owner
+    session.add(Movie(name='Seeded', genre_id=genre_id, user_id=user_id))
+    session.commit()
+
+    assert movie_archive.archive(session, days=30) == {}
+    assert movie_archive.archive(session, days=30, dry_run=True,
+                                 include_untracked=True) == {genre_id: 1}
+    assert session.query(Movie).count() == 1
+
+
+def test_only_the_owner_restores(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Old')
+    age(session, movie_id)
+    movie_archive.archive(session, days=30)
+    other = User(name='Other', email='other@example.com')
+    session.add(other)
+    session.commit()
+
+    assert movie_archive.unarchive(session, movie_id, other.id) == 'forbidden'
+    assert session.query(MovieArchive).count() == 1
+    assert movie_archive.unarchive(session, movie_id + 1) == 'not_found'
+
+
+def test_archived_ids_are_never_reused(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Last')
+    age(session, movie_id)
+    movie_archive.archive(session, days=30)
+
+    new_id = create_movie(session, genre_id, user_id, 'Next')
+    assert new_id > movie_id
+    assert movie_archive.unarchive(session, movie_id) == 'restored'
+
+
+def test_taken_id_is_a_conflict(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Live')
+    # What a SQLite table from before AUTOINCREMENT could end up with
+    session.execute(MovieArchive.__table__.insert().values(
+        id=movie_id, genre_id=genre_id, user_id=user_id, version=1,
+        data=movie_archive.pack('Archived', None)))
+    session.commit()
+
+    assert movie_archive.unarchive(session, movie_id) == 'conflict'
+    assert session.get(Movie, movie_id).name == 'Live'
+    assert session.query(MovieArchive).count() == 1
@@ -0,0 +1,83 @@
+from database_setup import Movie, User
+import change_feed
+import genre_stats
+from movie_writes import (
+    apply_movie_batch,
+    create_movie,
+    delete_owned_movie,
+    update_owned_movie
+)
+
+
+def test_update_bumps_the_version(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Alien')
+
+    assert update_owned_movie(session, movie_id, user_id, 1,
+                              name='Aliens') == 'updated'
+    movie = session.get(Movie, movie_id)
+    assert (movie.name, movie.version) == ('Aliens', 2)
+
+
+def test_stale_version_is_a_conflict(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Alien')
+    # Two forms rendered at version 1, the first save wins
+    assert update_owned_movie(session, movie_id, user_id, 1,
+                              name='First') == 'updated'
+
+    assert update_owned_movie(session, movie_id, user_id, 1,
+                              name='Second') == 'conflict'
+    session.expire_all()
+    movie = session.get(Movie, movie_id)
+    assert (movie.name, movie.version) == ('First', 2)
+
+
+def test_conflict_logs_nothing(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Alien')
+    update_owned_movie(session, movie_id, user_id, 1, name='First')
+    version = change_feed.current_version(session)
+
+    update_owned_movie(session, movie_id, user_id, 1, name='Second')
+    assert change_feed.current_version(session) == version
+
+
+def test_update_of_someone_elses_movie(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Alien')
+    other = User(name='Other', email='other@example.com')
+    session.add(other)
+    session.commit()
+
+    assert update_owned_movie(session, movie_id, other.id, 1,
+                              name='Mine') == 'forbidden'
+    assert update_owned_movie(session, movie_id + 1, user_id, 1,
+                              name='Gone') == 'not_found'
+
+
+def test_delete_updates_the_counts(session, owner):
+    user_id, genre_id = owner
+    movie_id = create_movie(session, genre_id, user_id, 'Alien')
+    assert genre_stats.movie_count(session, genre_id) == 1
+
+    assert delete_owned_movie(session, movie_id, user_id) == 'deleted'
+    assert genre_stats.movie_count(session, genre_id) == 0
+    assert delete_owned_movie(session, movie_id, user_id) == 'not_found'
+    assert genre_stats.movie_count(session, genre_id) == 0
+
+
+def test_batch_bumps_versions_and_rejects_bools(session, owner):
+    user_id, genre_id = owner
+    results = apply_movie_batch(session, user_id, [
+        {'op': 'create', 'genre_id': genre_id, 'name': 'A'},
+        {'op': 'create', 'genre_id': True, 'name': 'B'},
+    ])
+    assert [result['status'] for result in results] == ['created',
+                                                        'invalid']
+    movie_id = results[0]['id']
+
+    results = apply_movie_batch(session, user_id, [
+        {'op': 'update', 'id': movie_id, 'name': 'A2'}])
+    assert results[0]['status'] == 'updated'
+    assert session.get(Movie, movie_id).version == 2
@@ -0,0 +1,81 @@
+import pytest
+
+import ratelimit
+from ratelimit import SQLiteStore, parse_limit, refill
+
+# 3 requests, then one a second
+LIMIT = (3.0, 1.0)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteStore(str(tmp_path / 'buckets.sqlite'))
+
+
+def test_parse_limit():
+    assert parse_limit('120/60') == (120.0, 2.0)
+    assert parse_limit('0') is None
+
+
+def test_refill_is_capped_at_capacity():
+    assert refill(0.0, 10.0, 3.0, 1.0, 11.5) == 1.5
+    assert refill(2.0, 10.0, 3.0, 1.0, 100.0) == 3.0
+    # A clock going backwards doesn't drain the bucket
+    assert refill(2.0, 10.0, 3.0, 1.0, 9.0) == 2.0
+
+
+def test_take_until_empty_then_wait(store):
+    bucket = [('api:1.2.3.4', LIMIT)]
+    assert [store.take(bucket, 100.0) for _ in range(3)] == [0, 0, 0]
+    assert store.take(bucket, 100.0) == pytest.approx(1.0)
+    assert store.take(bucket, 100.5) == pytest.approx(0.5)
+
+
+def test_refused_requests_cost_nothing(store):
+    bucket = [('api:1.2.3.4', LIMIT)]
+    for _ in range(3):
+        store.take(bucket, 100.0)
+    for _ in range(5):
+        assert store.take(bucket, 100.0) > 0
+
+    # One second later exactly one token is back
+    assert store.take(bucket, 101.0) == 0
+    assert store.take(bucket, 101.0) > 0
+
+
+def test_clients_have_their_own_buckets(store):
+    for _ in range(3):
+        store.take([('api:a', LIMIT)], 100.0)
+
+    assert store.take([('api:a', LIMIT)], 100.0) > 0
+    assert store.take([('api:b', LIMIT)], 100.0) == 0
+
+
+def test_every_bucket_needs_a_token(store):
+    total = ('api:*', (2.0, 1.0))
+    assert store.take([('api:a', LIMIT), total], 100.0) == 0
+    assert store.take([('api:b', LIMIT), total], 100.0) == 0
+    # The total is empty, so client c is refused without being charged
+    assert store.take([('api:c', LIMIT), total], 100.0) > 0
+    assert store.take([('api:c', LIMIT)], 100.0) == 0
+    assert store.take([('api:c', LIMIT)], 100.0) == 0
+    assert store.take([('api:c', LIMIT)], 100.0) == 0
+
+
+def test_wait_time_per_endpoint_group(store, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'store', store)
+    monkeypatch.setattr(ratelimit, 'RULES', {
+        'solo_json': ('api', LIMIT, None)})
+
+    assert [ratelimit.wait_time('solo_json', '1.2.3.4', now=100.0)
+            for _ in range(4)][-1] > 0
+    # Routes without a rule are never limited
+    assert ratelimit.wait_time('show_catalog', '1.2.3.4', now=100.0) == 0
+
+
+def test_client_address_behind_proxies(monkeypatch):
+    assert ratelimit.client_address('10.0.0.1', '1.2.3.4') == '10.0.0.1'
+    monkeypatch.setattr(ratelimit, 'PROXIES', 1)
+    assert ratelimit.client_address('127.0.0.1',
+                                    '6.6.6.6, 1.2.3.4') == '1.2.3.4'
+    assert ratelimit.client_address('127.0.0.1', None) == '127.0.0.1'
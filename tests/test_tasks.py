@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+
+from database_setup import Task
+import tasks
+
+calls = []
+
+
+@tasks.task('test_record')
+def record(value):
+    calls.append(value)
+
+
+@tasks.task('test_fail')
+def fail():
+    raise RuntimeError('provider down')
+
+
+@pytest.fixture(autouse=True)
+def no_calls():
+    del calls[:]
+
+
+def make_due(session):
+    session.query(Task).update({'run_at': datetime.datetime(2000, 1, 1)})
+    session.commit()
+
+
+def test_job_runs_once_and_is_deleted(session):
+    tasks.enqueue(session, 'test_record', value=7)
+
+    assert tasks.run_one(session)
+    assert calls == [7]
+    assert session.query(Task).count() == 0
+    assert not tasks.run_one(session)
+
+
+def test_unknown_job_is_refused(session):
+    with pytest.raises(KeyError):
+        tasks.enqueue(session, 'no_such_job')
+
+
+def test_claimed_job_isnt_claimed_again(session):
+    tasks.enqueue(session, 'test_record', value=1)
+
+    job = tasks.claim(session)
+    assert (job.name, job.attempts) == ('test_record', 1)
+    # Nothing held open while the job runs
+    assert not session.in_transaction()
+    assert tasks.claim(session) is None
+    assert not session.in_transaction()
+
+
+def test_failed_job_is_retried_later(session):
+    tasks.enqueue(session, 'test_fail')
+
+    assert tasks.run_one(session)
+    job = session.query(Task).one()
+    assert (job.state, job.attempts, job.locked_until) == ('queued', 1,
+                                                          None)
+    assert 'provider down' in job.last_error
+    assert job.run_at > datetime.datetime.utcnow()
+    # Backing off: not due yet
+    assert not tasks.run_one(session)
+
+    make_due(session)
+    assert tasks.run_one(session)
+    session.expire_all()
+    assert session.query(Task).one().attempts == 2
+
+
+def test_job_fails_for_good_after_its_attempts(session, monkeypatch):
+    monkeypatch.setattr(tasks, 'ATTEMPTS', 2)
+    tasks.enqueue(session, 'test_fail')
+
+    for attempt in range(2):
+        make_due(session)
+        assert tasks.run_one(session)
+    session.expire_all()
+    job = session.query(Task).one()
+    assert (job.state, job.attempts) == ('failed', 2)
+    make_due(session)
+    assert not tasks.run_one(session)
+
+
+def test_expired_lease_is_claimed_again(session):
+    tasks.enqueue(session, 'test_record', value=1)
+    tasks.claim(session)
+    # The worker that claimed it died
+    session.query(Task).update(
+        {'locked_until': datetime.datetime(2000, 1, 1)})
+    session.commit()
+
+    assert tasks.run_one(session)
+    assert calls == [1]
@@ -0,0 +1,45 @@
+from database_setup import User
+
+
+def login(name, email, picture=None):
+    return {'username': name, 'email': email, 'picture': picture}
+
+
+def test_first_login_creates_the_user(catalog, session):
+    user_id = catalog.upsertUser(login('Ann', 'ann@example.com', 'a.jpg'))
+    catalog.session.remove()
+
+    user = session.get(User, user_id)
+    assert (user.name, user.email, user.picture) == ('Ann',
+                                                     'ann@example.com',
+                                                     'a.jpg')
+
+
+def test_next_login_refreshes_name_and_picture(catalog, session):
+    user_id = catalog.upsertUser(login('Ann', 'ann@example.com', 'a.jpg'))
+    again = catalog.upsertUser(login('Ann B', 'ann@example.com', 'b.jpg'))
+    catalog.session.remove()
+
+    assert again == user_id
+    assert session.query(User).count() == 1
+    user = session.get(User, user_id)
+    assert (user.name, user.picture) == ('Ann B', 'b.jpg')
+
+
+def test_users_are_told_apart_by_email(catalog, session):
+    ann = catalog.upsertUser(login('Ann', 'ann@example.com'))
+    bob = catalog.upsertUser(login('Ann', 'bob@example.com'))
+    catalog.session.remove()
+
+    assert ann != bob
+    assert session.query(User).count() == 2
+
+
+def test_upsert_statement_per_dialect(catalog):
+    values = {'name': 'Ann', 'email': 'ann@example.com', 'picture': None}
+    postgres = catalog.upsertUserStatement('postgresql', values)
+    sqlite = catalog.upsertUserStatement('sqlite', values)
+
+    assert postgres._returning
+    assert not sqlite._returning
+    assert catalog.upsertUserStatement('mysql', values) is None
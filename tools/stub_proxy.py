@@ -0,0 +1,127 @@
+"""
+A tiny caching reverse proxy for trying proxy_cache.py out locally
+
+It behaves like the parts of Varnish (with xkey) the app relies on
+- Caches GET responses sent with 'Cache-Control: public' and s-maxage, for
+  s-maxage seconds, indexed by their Surrogate-Key header
+- Requests carrying the 'logged_in' cookie always go to the app
+- 'PURGE /' with a 'Surrogate-Key: a b c' header drops every cached response
+  tagged with any of those keys
+- Answers carry 'X-Cache: HIT' or 'X-Cache: MISS'
+
+Usage
+    python tools/stub_proxy.py [--port 8080] [--backend http://localhost:8000]
+and run the app with CATALOG_PURGE_URL=http://localhost:8080/
+"""
+import argparse
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Hop-by-hop headers, and the ones requests already decoded for us
+SKIP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding',
+                'content-encoding', 'content-length')
+
+
+class Cache(object):
+    def __init__(self):
+        self.entries = {}   # url -> (expires, status, headers, body, keys)
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and entry[0] > time.time():
+                return entry[1:4]
+            self.entries.pop(url, None)
+
+    def put(self, url, seconds, status, headers, body, keys):
+        with self.lock:
+            self.entries[url] = (time.time() + seconds, status, headers, body,
+                                 set(keys))
+
+    def purge(self, keys):
+        with self.lock:
+            urls = [url for url, entry in self.entries.items()
+                    if entry[4] & keys]
+            for url in urls:
+                del self.entries[url]
+        return len(urls)
+
+
+def shared_max_age(headers):
+    cache_control = headers.get('Cache-Control', '')
+    match = re.search(r's-maxage=(\d+)', cache_control)
+    if 'public' not in cache_control or not match:
+        return 0
+    return int(match.group(1))
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    backend = None
+    cache = Cache()
+
+    def send(self, status, headers, body, hit):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', 'HIT' if hit else 'MISS')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def forward(self, body=None):
+        headers = dict((k, v) for k, v in self.headers.items()
+                       if k.lower() not in ('host', 'accept-encoding'))
+        return requests.request(self.command, self.backend + self.path,
+                                headers=headers, data=body,
+                                allow_redirects=False)
+
+    def do_GET(self):
+        bypass = 'logged_in=' in self.headers.get('Cookie', '')
+        if not bypass:
+            cached = self.cache.get(self.path)
+            if cached:
+                return self.send(*cached, hit=True)
+
+        response = self.forward()
+        headers = [(k, v) for k, v in response.headers.items()
+                   if k.lower() not in SKIP_HEADERS]
+        seconds = shared_max_age(response.headers)
+        if not bypass and seconds and response.status_code == 200:
+            keys = response.headers.get('Surrogate-Key', '').split()
+            self.cache.put(self.path, seconds, response.status_code, headers,
+                           response.content, keys)
+        self.send(response.status_code, headers, response.content, hit=False)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        response = self.forward(self.rfile.read(length))
+        headers = [(k, v) for k, v in response.headers.items()
+                   if k.lower() not in SKIP_HEADERS]
+        self.send(response.status_code, headers, response.content, hit=False)
+
+    def do_PURGE(self):
+        keys = set(self.headers.get('Surrogate-Key', '').split())
+        purged = self.cache.purge(keys)
+        self.log_message("purged %d for %s", purged, ' '.join(sorted(keys)))
+        self.send(200, [('Content-Type', 'text/plain')],
+                  b'purged %d\n' % purged, hit=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--backend', default='http://localhost:8000')
+    args = parser.parse_args()
+
+    ProxyHandler.backend = args.backend.rstrip('/')
+    server = ThreadingHTTPServer(('', args.port), ProxyHandler)
+    print("Caching %s on port %d" % (ProxyHandler.backend, args.port))
+    server.serve_forever()
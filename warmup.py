@@ -0,0 +1,102 @@
+"""
+This file warms a worker up before it takes traffic
+
+Right after a deploy the first requests on every worker pay for opening
+database connections, compiling SQL, compiling templates and filling empty
+caches. Warmup runs those steps once at startup instead and keeps the time
+each one took
+
+The readiness endpoint in __init__.py (/ready) reports healthy only once
+every step has succeeded, so a load balancer can hold traffic back until then
+
+Settings (environment variables)
+    CATALOG_WARMUP               set to 0 to skip warm-up (1)
+    CATALOG_WARMUP_CONNECTIONS   pool connections to open per engine (5)
+"""
+import logging
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('CATALOG_WARMUP', '1') != '0'
+CONNECTIONS = int(os.environ.get('CATALOG_WARMUP_CONNECTIONS', '5'))
+
+log = logging.getLogger(__name__)
+
+
+def open_pool(engines, count=CONNECTIONS):
+    '''
+        Opens count connections on each engine at the same time and hands
+        them back, leaving them idle in the pool.
+    '''
+    for engine in engines:
+        # No more than the pool keeps (a single connection for sqlite_mode's
+        # writer), the rest would wait for a free one
+        opened = count
+        size = getattr(engine.pool, 'size', None)
+        if callable(size):
+            opened = min(count, size())
+        connections = [engine.connect() for _ in range(opened)]
+        for connection in connections:
+            connection.close()
+
+
+class Warmup(object):
+    '''
+        Runs named warm-up steps and remembers how they went.
+
+        Attributes
+            ready (bool): True once every step succeeded
+            timings (dict): Step name -> seconds, for the last run
+            error (str): Why the last run failed, None if it didn't
+    '''
+    def __init__(self, steps):
+        self.steps = steps
+        self.ready = False
+        self.timings = {}
+        self.error = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        '''
+            Runs all steps in order, stopping at the first failure.
+
+            Returns
+                ready (bool): Whether the worker is warm
+        '''
+        # Readiness probes may retry a failed warm-up, only one at a time
+        if not self._lock.acquire(blocking=False):
+            return self.ready
+        try:
+            timings = {}
+            self.error = None
+            for name, step in self.steps:
+                start = time.perf_counter()
+                try:
+                    step()
+                except Exception as e:
+                    self.error = '%s: %s' % (name, e)
+                    log.exception("Warm-up step %s failed", name)
+                    return False
+                finally:
+                    timings[name] = time.perf_counter() - start
+                    self.timings = timings
+            self.ready = True
+            log.info("Warm-up done: %s", ', '.join(
+                '%s %.1f ms' % (name, seconds * 1000)
+                for name, seconds in timings.items()))
+            return True
+        finally:
+            self._lock.release()
+
+    def status(self):
+        '''
+            Returns
+                status (dict): Ready flag, timings in ms and error
+        '''
+        return {
+            'ready': self.ready,
+            'timings_ms': dict((name, round(seconds * 1000, 2))
+                               for name, seconds in self.timings.items()),
+            'error': self.error
+        }